@@ -1,42 +1,129 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import re
 import os
 import json
+import fcntl
 import logging
-from shutil import copyfile
+from shutil import copyfileobj
 from argparse import ArgumentParser
+from log_tail import load_state, save_state, read_new_lines
+from fairseq_log import valid_records
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
+# Linux ioctl for sharing the data blocks of a file (reflink),
+# supported e.g. by Btrfs and XFS
+FICLONE = 0x40049409
+# Chunk size for copying a checkpoint
+COPY_CHUNK_SIZE = 16 << 20
 
-def duplicate_best_checkpoint(model_path):
+
+def reflink(src, dst):
+    """
+    Make dst a copy-on-write clone of src
+    """
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+
+
+def hardlink(src, dst):
+    """
+    Make dst another name of src
+    """
+    os.link(src, dst)
+
+
+def symlink(src, dst):
+    """
+    Make dst a symbolic link to src (relative, both are in the model dir)
+    """
+    os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+
+
+def chunked_copy(src, dst):
+    """
+    Copy src into dst in large chunks
+    """
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        copyfileobj(src_fh, dst_fh, COPY_CHUNK_SIZE)
+        dst_fh.flush()
+        os.fsync(dst_fh.fileno())
+
+
+# Ways of promoting a checkpoint, from the cheapest to the most expensive
+PROMOTION_METHODS = (('reflink', reflink), ('hardlink', hardlink),
+                     ('symlink', symlink), ('copy', chunked_copy))
+
+
+def promote_checkpoint(src, dst, methods=None):
+    """
+    Make dst have the content of src using the first of methods
+    (names from PROMOTION_METHODS, all by default) that works;
+    the result is made under a temporary name and renamed into dst,
+    so dst is never incomplete; return the name of the method used
+    """
+    temp_file = dst + '.tmp'
+    for name, method in PROMOTION_METHODS:
+        if methods is not None and name not in methods:
+            continue
+        if os.path.lexists(temp_file):
+            os.remove(temp_file)
+        try:
+            method(src, temp_file)
+            os.replace(temp_file, dst)
+            return name
+        except OSError as error:
+            logging.debug(f"Promotion by {name} failed: {error}")
+            if os.path.lexists(temp_file):
+                os.remove(temp_file)
+    raise OSError(f"Could not promote {src} into {dst}")
+
+
+def duplicate_best_checkpoint(model_path, rescan=False, methods=None):
+    """
+    Promote the checkpoint with the best validation BLEU into
+    checkpoint_best_dev_bleu.pt (see promote_checkpoint), unless it
+    is already there; only the lines appended to the log since the last
+    run are parsed, the offset in the log, the best BLEU so far and
+    the promoted epoch are saved into log.out.best_bleu-state.json
+    (with rescan, the whole log is parsed)
+    """
+    log_file = model_path + '/log.out'
+    state_file = log_file + '.best_bleu-state.json'
+    state = load_state(state_file, rescan)
     best_epoch = 0
     max_bleu = 0
 
-    # compile regular expressions
-    valid_info = re.compile(r"""INFO \| valid \| {.+}""")
-    epoch = re.compile(r"""\"epoch\": ([0-9]+)""")
-    val_bleu = re.compile(r"""\"valid_bleu\": \"([0-9]+\.?[0-9]*)\"""")
-
-    # iterate over log lines
-    with open(model_path + '/log.out', 'r', encoding='utf8') as log_fh:
-        for line in log_fh:
-            if valid_info.search(line):
-                current_epoch = int(epoch.search(line).group(1))
-                current_bleu = float(val_bleu.search(line).group(1))
-                if current_bleu > max_bleu:
-                    max_bleu = current_bleu
-                    best_epoch = current_epoch
-
-    # copy best checkpoint into a new file
-    copyfile("{0}/checkpoint{1}.pt".format(model_path, str(best_epoch)),
-             "{0}/checkpoint_best_dev_bleu.pt".format(model_path))
-    logging.info("Copied {0}/checkpoint{1}.pt into \
-                  {0}/checkpoint_best_dev_bleu.pt".
-                 format(model_path, str(best_epoch)))
+    # iterate over the validation records among the new log lines
+    for record in valid_records(read_new_lines(log_file, state)):
+        if record.get('bleu', 0) > max_bleu:
+            max_bleu = record['bleu']
+            best_epoch = record['epoch']
+
+    # keep the best result of the previous runs unless a new one beats it
+    previous = state['data'] or {}
+    if previous and previous['max_bleu'] >= max_bleu:
+        best_epoch = previous['best_epoch']
+        max_bleu = previous['max_bleu']
+    state['data'] = {'best_epoch': best_epoch, 'max_bleu': max_bleu,
+                     'promoted_epoch': previous.get('promoted_epoch')}
+
+    best_checkpoint = "{0}/checkpoint{1}.pt".format(model_path, best_epoch)
+    promoted_checkpoint = "{0}/checkpoint_best_dev_bleu.pt".format(model_path)
+    # nothing to do if the best checkpoint has already been promoted
+    if (state['data']['promoted_epoch'] == best_epoch and
+            os.path.exists(promoted_checkpoint)):
+        logging.info("Best epoch {0} is already in {1}".format(
+            best_epoch, promoted_checkpoint))
+    else:
+        method = promote_checkpoint(best_checkpoint, promoted_checkpoint,
+                                    methods)
+        state['data']['promoted_epoch'] = best_epoch
+        logging.info("Promoted {0} into {1} ({2})".format(
+            best_checkpoint, promoted_checkpoint, method))
+    save_state(state_file, state)
     return 0
 
 
@@ -47,10 +134,19 @@ if __name__ == '__main__':
                         help="Model directory containing the log file")
     # parser.add_argument("--output", type=str,
     #                     help="Output file", default="metrics.json")
+    parser.add_argument("--rescan", action='store_true', default=False,
+                        help="Parse the whole log again instead of "
+                             "only the lines added since the last run")
+    parser.add_argument("--methods", nargs='+', default=None,
+                        choices=[name for name, _ in PROMOTION_METHODS],
+                        help="Ways of promoting the best checkpoint, "
+                             "tried in the order reflink, hardlink, "
+                             "symlink, copy (all by default)")
 
     args = parser.parse_args()
 
     if not os.path.isfile(args.modeldir + '/log.out'):
         logging.info(f"File {args.modeldir}/log.out does not exist, exiting")
     else:
-        duplicate_best_checkpoint(model_path=args.modeldir)
+        duplicate_best_checkpoint(model_path=args.modeldir,
+                                  rescan=args.rescan, methods=args.methods)
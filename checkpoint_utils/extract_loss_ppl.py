@@ -1,49 +1,54 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import re
 import os
 import json
 import logging
 from argparse import ArgumentParser
+from log_tail import load_state, save_state, read_new_lines
+from fairseq_log import valid_records, add_records
+from metrics_store import append_metrics
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
 
-def extract_metrics(model_path, out_path):
-    out_dict = {'epoch': [], 'loss': [], 'ppl': [], 'bleu': []}
+def extract_metrics(model_path, out_path, rescan=False):
+    """
+    Extract validation metrics (epoch, loss, ppl, bleu, wps, num_updates
+    etc., as numbers) from the log of the model; only the lines appended
+    since the last run are parsed, the offset in the log and the metrics
+    found so far are saved into log.out.val_metrics-state.json
+    (with rescan, the whole log is parsed again);
+    the metrics of the new epochs are appended to the store out_path
+    (JSON lines), see metrics_store.py for querying and exporting them
+    """
+    log_file = model_path + '/log.out'
+    state_file = log_file + '.val_metrics-state.json'
+    state = load_state(state_file, rescan, version=2)
 
-    # compile regular expressions
-    valid_info = re.compile(r"""INFO \| valid \| {.+}""")
-    epoch = re.compile(r"""\"epoch\": ([0-9]+)""")
-    val_loss = re.compile(r"""\"valid_loss\": \"([0-9]+\.?[0-9]*)\"""")
-    val_ppl = re.compile(r"""\"valid_ppl\": \"([0-9]+\.?[0-9]*)\"""")
-    val_bleu = re.compile(r"""\"valid_bleu\": \"([0-9]+\.?[0-9]*)\"""")
+    # parse the validation records among the new log lines
+    new_records = list(valid_records(read_new_lines(log_file, state)))
 
-    # iterate over log lines
-    with open(model_path + '/log.out', 'r', encoding='utf8') as log_fh:
-        for line in log_fh:
-            if valid_info.search(line):
-                out_dict['epoch'].append(epoch.search(line).group(1))
-                out_dict['loss'].append(val_loss.search(line).group(1))
-                out_dict['ppl'].append(val_ppl.search(line).group(1))
-                out_dict['bleu'].append(val_bleu.search(line).group(1))
+    # add the new metrics to the ones found in the previous runs
+    out_dict = add_records(state['data'] or {'epoch': [], 'loss': [],
+                                             'ppl': [], 'bleu': []},
+                           new_records)
 
     # write result into a json file in model directory
     with open(model_path + 'val_metrics.json', 'w', encoding='utf8') as out_fh:
         json.dump(out_dict, out_fh, indent=4)
 
-    if os.path.isfile(out_path):
-        with open(out_path, 'r', encoding='utf8') as common_out:
-            prior_dicts = json.load(common_out)
-    else:
-        prior_dicts = []
-
-    prior_dicts.append({model_path: out_dict})
+    # add only the new epochs to the common store without rewriting it
+    if new_records:
+        append_metrics(out_path, model_path,
+                       add_records({'epoch': [], 'loss': [], 'ppl': [],
+                                    'bleu': []}, new_records))
 
-    with open(out_path, 'w', encoding='utf8') as common_out:
-        json.dump(prior_dicts, common_out, indent=4)
+    # save the log offset last: if the run stops before this, the next
+    # run reads the same lines again (the store merges repeated epochs)
+    state['data'] = out_dict
+    save_state(state_file, state)
 
     return 0
 
@@ -54,11 +59,16 @@ if __name__ == '__main__':
     parser.add_argument("--modeldir", type=str, required=True,
                         help="Model directory containing the log file")
     parser.add_argument("--output", type=str,
-                        help="Output file", default="metrics.json")
+                        help="Metrics store shared by all models "
+                             "(JSON lines)", default="metrics.jsonl")
+    parser.add_argument("--rescan", action='store_true', default=False,
+                        help="Parse the whole log again instead of "
+                             "only the lines added since the last run")
 
     args = parser.parse_args()
 
     if not os.path.isfile(args.modeldir + '/log.out'):
         print(f"File {args.modeldir}/log.out does not exist, exiting")
     else:
-        extract_metrics(model_path=args.modeldir, out_path=args.output)
+        extract_metrics(model_path=args.modeldir, out_path=args.output,
+                        rescan=args.rescan)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import time
+import logging
+from argparse import ArgumentParser
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+# Validation lines look like "... | INFO | valid | {json payload}"
+VALID_TAG = '| valid |'
+# Metrics that are counts, the others are floats
+INT_METRICS = ('epoch', 'num_updates')
+
+
+def to_number(metric, value):
+    """
+    Convert a metric value (fairseq logs most of them as strings)
+    into an int or a float, non-numeric values are kept as they are
+    """
+    try:
+        return int(value) if metric in INT_METRICS else float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def parse_valid_record(line):
+    """
+    Return the metrics of a validation log line as a dict with typed
+    values and without the "valid_" prefix in the names (e.g. epoch,
+    loss, ppl, bleu, best_bleu, wps, ups, num_updates),
+    return None for other lines
+    """
+    tag_start = line.find(VALID_TAG)
+    if tag_start < 0:
+        return None
+    payload_start = line.find('{', tag_start + len(VALID_TAG))
+    if payload_start < 0:
+        return None
+    try:
+        payload = json.loads(line[payload_start:])
+    except ValueError:
+        return None
+    record = {}
+    for key, value in payload.items():
+        metric = key[len('valid_'):] if key.startswith('valid_') else key
+        record[metric] = to_number(metric, value)
+    return record
+
+
+def valid_records(lines):
+    """
+    Yield the metrics of the validation lines among lines
+    """
+    for line in lines:
+        # cheap test first, most lines are training progress
+        if VALID_TAG in line:
+            record = parse_valid_record(line)
+            if record is not None:
+                yield record
+
+
+def add_records(columns, records):
+    """
+    Add records to columns (a dict of metric name -> list of values),
+    a metric missing from a record gets the value None
+    """
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    for record in records:
+        for metric in record:
+            if metric not in columns:
+                columns[metric] = [None] * n_rows
+        for metric, values in columns.items():
+            values.append(record.get(metric))
+        n_rows += 1
+    return columns
+
+
+def regex_valid_records(lines):
+    """
+    Previous regex-based parser (only epoch, loss, ppl and bleu,
+    as strings), kept for benchmarking
+    """
+    valid_info = re.compile(r"""INFO \| valid \| {.+}""")
+    epoch = re.compile(r"""\"epoch\": ([0-9]+)""")
+    val_loss = re.compile(r"""\"valid_loss\": \"([0-9]+\.?[0-9]*)\"""")
+    val_ppl = re.compile(r"""\"valid_ppl\": \"([0-9]+\.?[0-9]*)\"""")
+    val_bleu = re.compile(r"""\"valid_bleu\": \"([0-9]+\.?[0-9]*)\"""")
+    for line in lines:
+        if valid_info.search(line):
+            yield {'epoch': epoch.search(line).group(1),
+                   'loss': val_loss.search(line).group(1),
+                   'ppl': val_ppl.search(line).group(1),
+                   'bleu': val_bleu.search(line).group(1)}
+
+
+def benchmark(log_file, repeat=3):
+    """
+    Compare the throughput of the JSON and the regex parser on log_file
+    and check that they find the same epoch, loss, ppl and bleu values
+    """
+    with open(log_file, 'r', encoding='utf8') as log_fh:
+        lines = log_fh.readlines()
+    results = {}
+    for name, parser in (('json', valid_records),
+                         ('regex', regex_valid_records)):
+        best_time = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            records = list(parser(lines))
+            best_time = min(best_time, time.perf_counter() - start_time)
+        results[name] = records
+        logging.info('{0}: {1} records from {2} lines in {3:.3f} s '
+                     '({4:.0f} lines/sec)'.format(
+                         name, len(records), len(lines), best_time,
+                         len(lines) / best_time if best_time else 0))
+    same = (len(results['json']) == len(results['regex']) and
+            all(to_number(metric, regex_record[metric]) ==
+                json_record.get(metric)
+                for json_record, regex_record
+                in zip(results['json'], results['regex'])
+                for metric in regex_record))
+    logging.info('Parsers agree: {}'.format(same))
+    return same
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = ArgumentParser(description="""Benchmark parsing the
+    validation metrics of a fairseq log with JSON against regexes""")
+    parser.add_argument("--log", type=str, required=True,
+                        help="fairseq log file (e.g. MODELDIR/log.out)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs, the best one is shown")
+
+    args = parser.parse_args()
+
+    benchmark(args.log, args.repeat)
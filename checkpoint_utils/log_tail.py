@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+
+# Number of bytes at the start of the log used to recognize it
+HEAD_SIZE = 4096
+
+
+def head_hash(log_fh, offset):
+    """
+    Hash of the first bytes of the log (at most up to offset),
+    to notice when the log has been replaced by a new one
+    """
+    log_fh.seek(0)
+    return hashlib.sha1(log_fh.read(min(offset, HEAD_SIZE))).hexdigest()
+
+
+def load_state(state_file, rescan=False, version=1):
+    """
+    Load the saved log offset and cached results, or return
+    an empty state if there is none (or if rescan is True, or if
+    the results were cached in another format version)
+    """
+    empty_state = {'offset': 0, 'head': None, 'data': None,
+                   'version': version}
+    if rescan or not os.path.isfile(state_file):
+        return empty_state
+    with open(state_file, 'r', encoding='utf8') as state_fh:
+        state = json.load(state_fh)
+    if state.get('version', 1) != version:
+        return empty_state
+    return state
+
+
+def save_state(state_file, state):
+    """
+    Save the log offset and cached results, the file is replaced
+    atomically so that an interrupted run does not corrupt it
+    """
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf8') as state_fh:
+        json.dump(state, state_fh)
+    os.replace(temp_file, state_file)
+
+
+def read_new_lines(log_file, state):
+    """
+    Yield the lines appended to log_file since the offset saved in state
+    and move the offset past them; a line that is still being written
+    (no newline yet) is left for the next run; if the log is shorter
+    than the offset or starts differently, it is a new log: the offset
+    and the cached results (state['data']) are reset
+    """
+    with open(log_file, 'rb') as log_fh:
+        offset = state['offset']
+        log_fh.seek(0, os.SEEK_END)
+        if (log_fh.tell() < offset or
+                head_hash(log_fh, offset) != state['head']):
+            offset, state['data'] = 0, None
+        log_fh.seek(offset)
+        for line in log_fh:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            yield line.decode('utf8')
+        state['offset'] = offset
+        state['head'] = head_hash(log_fh, offset)
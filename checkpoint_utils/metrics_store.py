@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import sys
+import json
+import time
+import fcntl
+import logging
+from collections import OrderedDict
+from argparse import ArgumentParser
+from fairseq_log import add_records
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+
+def append_metrics(store_file, model_path, metrics):
+    """
+    Append the metrics of a model (a dict of metric name -> list
+    of values, usually only the epochs added since the last entry)
+    as one JSON line to store_file; the file is locked while writing,
+    so that jobs running at the same time do not mix up their lines
+    """
+    entry = json.dumps({'model': model_path, 'time': time.time(),
+                        'metrics': metrics})
+    with open(store_file, 'a', encoding='utf8') as store_fh:
+        fcntl.flock(store_fh, fcntl.LOCK_EX)
+        try:
+            store_fh.write(entry + '\n')
+            store_fh.flush()
+        finally:
+            fcntl.flock(store_fh, fcntl.LOCK_UN)
+
+
+def read_metrics(store_file):
+    """
+    Yield the entries of store_file (dicts with model, time and metrics),
+    a line that is not complete JSON (an interrupted write) is skipped
+    """
+    with open(store_file, 'r', encoding='utf8') as store_fh:
+        fcntl.flock(store_fh, fcntl.LOCK_SH)
+        try:
+            for line_num, line in enumerate(store_fh, 1):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning(f'Skipping broken line {line_num} '
+                                    f'in {store_file}')
+        finally:
+            fcntl.flock(store_fh, fcntl.LOCK_UN)
+
+
+def merge_entries(entries):
+    """
+    Merge the entries of each model into one entry with all its epochs
+    (models in the order of their last entry); a row of an epoch
+    that is already there (the log was parsed again) replaces it
+    """
+    models = OrderedDict()
+    for entry in entries:
+        _, rows = models.pop(entry['model'], (None, OrderedDict()))
+        metrics = entry['metrics']
+        n_rows = max((len(values) for values in metrics.values()), default=0)
+        for row_num in range(n_rows):
+            row = {metric: values[row_num] if row_num < len(values) else None
+                   for metric, values in metrics.items()}
+            rows[row.get('epoch', len(rows))] = row
+        models[entry['model']] = (entry['time'], rows)
+    return [{'model': model, 'time': entry_time,
+             'metrics': add_records(OrderedDict(), rows.values())}
+            for model, (entry_time, rows) in models.items()]
+
+
+def query_metrics(store_file, models=None, merge=True):
+    """
+    Return the entries of the given models (all models by default),
+    with merge one entry per model with all its epochs
+    """
+    entries = [entry for entry in read_metrics(store_file)
+               if models is None or entry['model'] in models]
+    if merge:
+        entries = merge_entries(entries)
+    return entries
+
+
+def export_json(entries, out_fh):
+    """
+    Write the entries in the format of the former metrics.json
+    (a list of {model_path: metrics} dicts)
+    """
+    json.dump([{entry['model']: entry['metrics']} for entry in entries],
+              out_fh, indent=4)
+
+
+def export_table(entries, out_fh, delimiter=','):
+    """
+    Write the entries as a table with one row per model and epoch
+    """
+    columns = []
+    for entry in entries:
+        columns.extend(metric for metric in entry['metrics']
+                       if metric not in columns)
+    writer = csv.writer(out_fh, delimiter=delimiter, lineterminator='\n')
+    writer.writerow(['model'] + columns)
+    for entry in entries:
+        metrics = entry['metrics']
+        n_rows = max((len(values) for values in metrics.values()), default=0)
+        for row in range(n_rows):
+            writer.writerow([entry['model']] +
+                            [metrics[metric][row] if metric in metrics
+                             else None for metric in columns])
+
+
+def import_json(json_file, store_file):
+    """
+    Append the models of a metrics.json file of the former format
+    (a list of {model_path: metrics} dicts) to store_file
+    """
+    with open(json_file, 'r', encoding='utf8') as json_fh:
+        model_dicts = json.load(json_fh)
+    for model_dict in model_dicts:
+        for model_path, metrics in model_dict.items():
+            append_metrics(store_file, model_path, metrics)
+    return len(model_dicts)
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = ArgumentParser(description="""Query and export the metrics
+    store written by extract_loss_ppl.py""")
+    parser.add_argument("--store", type=str, default="metrics.jsonl",
+                        help="Metrics store (JSON lines)")
+    parser.add_argument("--models", nargs='+', default=None,
+                        help="Model directories to export (all by default)")
+    parser.add_argument("--all_entries", action='store_true', default=False,
+                        help="Export the entries as they were appended "
+                             "instead of one merged entry per model")
+    parser.add_argument("--format", choices=['json', 'csv', 'tsv'],
+                        default='json', help="Export format")
+    parser.add_argument("--output", type=str, default='-',
+                        help="Output file (standard output by default)")
+    parser.add_argument("--import_json", type=str, default=None,
+                        help="Append the models of a metrics.json file "
+                             "of the former format to the store")
+
+    args = parser.parse_args()
+
+    if args.import_json:
+        n_models = import_json(args.import_json, args.store)
+        logging.info(f"Added {n_models} models from {args.import_json} "
+                     f"to {args.store}")
+        sys.exit(0)
+
+    selected = query_metrics(args.store, args.models,
+                             merge=not args.all_entries)
+    if args.output == '-':
+        output_fh = open(sys.stdout.fileno(), 'w', encoding='utf8',
+                         closefd=False)
+    else:
+        output_fh = open(args.output, 'w', encoding='utf8', newline='')
+    with output_fh:
+        if args.format == 'json':
+            export_json(selected, output_fh)
+        else:
+            export_table(selected, output_fh,
+                         ',' if args.format == 'csv' else '\t')
+    logging.info(f"Exported {len(selected)} entries from {args.store}")
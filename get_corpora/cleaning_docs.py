@@ -3,12 +3,23 @@
 
 # Authors: Lisa Korotkova, Mark Fishel
 
+import sys
+import json
+import time
 import logging
+import numpy as np
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from multiprocessing import Pool
 from argparse import ArgumentParser
+from corpus_io import open_file
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
+# Lookup table of alphabetic code points, built on first use
+ALPHA_TABLE = None
+
 
 def filter_lines(docs, src_lines, tgt_lines):
     """
@@ -48,8 +59,8 @@ def pair_ok(doc, src_sent, tgt_sent):
         return False
 
     # Check for alphabetic characters
-    alpha_ratio_src = sum([c.isalpha() for c in src_sent]) / len(src_sent)
-    alpha_ratio_tgt = sum([c.isalpha() for c in tgt_sent]) / len(tgt_sent)
+    alpha_ratio_src = sum(map(str.isalpha, src_sent)) / len(src_sent)
+    alpha_ratio_tgt = sum(map(str.isalpha, tgt_sent)) / len(tgt_sent)
     if alpha_ratio_src < 0.5 or alpha_ratio_tgt < 0.5:
         return False
     else:
@@ -58,37 +69,188 @@ def pair_ok(doc, src_sent, tgt_sent):
     # return src_len <= 100 and tgt_len <= 100 and ratio < 9
 
 
-def filter_file(input_file, output_file):
+def alpha_table():
+    """
+    Return a boolean array telling for every Unicode code point
+    whether it is an alphabetic character
+    """
+    global ALPHA_TABLE
+    if ALPHA_TABLE is None:
+        n_code_points = sys.maxunicode + 1
+        ALPHA_TABLE = np.fromiter((chr(i).isalpha()
+                                   for i in range(n_code_points)),
+                                  dtype=bool, count=n_code_points)
+    return ALPHA_TABLE
+
+
+def count_chars(sents):
+    """
+    Count characters, spaces and alphabetic characters in each sentence,
+    return three NumPy arrays
+    """
+    lengths = np.fromiter(map(len, sents), dtype=np.int64, count=len(sents))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    # All sentences as one array of code points
+    code_points = np.frombuffer(
+        ''.join(sents).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    spaces = np.concatenate([[0], np.cumsum(code_points == 32)])
+    alphas = np.concatenate([[0], np.cumsum(alpha_table()[code_points])])
+    return (lengths, spaces[ends] - spaces[starts],
+            alphas[ends] - alphas[starts])
+
+
+def check_pairs(src_sents, tgt_sents):
+    """
+    Apply each rule of pair_ok to a batch of sentence pairs,
+    return a dict (in the order pair_ok checks the rules)
+    of boolean masks which are False for the pairs failing the rule
+    """
+    assert len(src_sents) == len(
+        tgt_sents), 'Source and target side not parallel'
+
+    src_len, src_spaces, src_alpha = count_chars(src_sents)
+    tgt_len, tgt_spaces, tgt_alpha = count_chars(tgt_sents)
+    # Number of tokens when splitting by " "
+    src_tokens, tgt_tokens = src_spaces + 1, tgt_spaces + 1
+    longer = np.maximum(src_tokens, tgt_tokens)
+    shorter = np.minimum(src_tokens, tgt_tokens)
+
+    return OrderedDict([
+        ('empty', (src_len > 0) & (tgt_len > 0)),
+        ('too_many_tokens', (src_tokens <= 100) & (tgt_tokens <= 100)),
+        ('length_ratio', longer <= 9 * shorter),
+        ('alpha_ratio', (2 * src_alpha >= src_len) &
+                        (2 * tgt_alpha >= tgt_len))])
+
+
+def pairs_ok(src_sents, tgt_sents):
+    """
+    Batch version of pair_ok: return a boolean mask which is False
+    for the same sentence pairs that pair_ok would discard
+    """
+    checks = check_pairs(src_sents, tgt_sents)
+    return np.logical_and.reduce(list(checks.values()))
+
+
+def clean_chunk(lines):
+    """
+    Parse a chunk of input lines (format
+    "doc_id__@delimeter@__src_sent__@delimeter@__tgt_sent"),
+    return the good sentence pairs as output lines
+    (format "doc_id\\tsrc_sent\\ttgt_sent") and a Counter of
+    rejected pairs per rule and of time spent on parsing and filtering
+    """
+    stats = Counter(lines=len(lines))
+    start_time = time.perf_counter()
+    docs, src_lines, tgt_lines = [], [], []
+    for line in lines:
+        try:
+            d, s, t = line.strip().split('__@delimeter@__')
+        except ValueError:
+            stats['malformed'] += 1
+            continue
+
+        docs.append(d)
+        src_lines.append(s.replace('\t', ' '))
+        tgt_lines.append(t.replace('\t', ' '))
+    parsed_time = time.perf_counter()
+    stats['parse_time'] += parsed_time - start_time
+
+    # A pair is counted as rejected by the first rule it fails
+    keep = np.ones(len(docs), dtype=bool)
+    for rule, passed in check_pairs(src_lines, tgt_lines).items():
+        stats[rule] += int(np.count_nonzero(keep & ~passed))
+        keep &= passed
+    out_lines = ['\t'.join([docs[i], src_lines[i], tgt_lines[i]]) + '\n'
+                 for i in np.flatnonzero(keep)]
+    stats['kept'] += len(out_lines)
+    stats['filter_time'] += time.perf_counter() - parsed_time
+    return out_lines, stats
+
+
+def read_chunks(fh, chunk_size):
+    """
+    Read lines from fh in lists of chunk_size lines
+    """
+    while True:
+        chunk = list(islice(fh, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def make_report(input_file, stats, total_time):
+    """
+    Make a dict of cleaning statistics for the JSON report
+    """
+    rules = list(check_pairs([], []).keys())
+    return OrderedDict([
+        ('input', input_file),
+        ('lines', stats['lines']),
+        ('malformed', stats['malformed']),
+        ('rejected', OrderedDict((rule, stats[rule]) for rule in rules)),
+        ('kept', stats['kept']),
+        ('time', OrderedDict([('parse', stats['parse_time']),
+                              ('filter', stats['filter_time']),
+                              ('write', stats['write_time']),
+                              ('total', total_time)])),
+        ('lines_per_sec', stats['lines'] / total_time if total_time else 0)])
+
+
+def filter_file(input_file, output_file, workers=1, chunk_size=100000,
+                stats_file=None):
     """
     Read lines from input_file (each line of format
     "doc_id__@delimeter@__src_sent__@delimeter@__tgt_sent"),
     remove bad sentence pairs, write good sentence pairs
-    into output_file (format "doc_id\\tsrc_sent\\ttgt_sent")
+    into output_file (format "doc_id\\tsrc_sent\\ttgt_sent");
+    either file can be gzip (.gz) or zstandard (.zst) compressed;
+    the file is read in chunks of chunk_size lines, which are cleaned
+    by a pool of processes and written in the original order;
+    if stats_file is given, statistics are saved into it in JSON format
+    (parse and filter times are summed over all processes)
     """
     logging.info('Cleaning {}'.format(input_file))
+    start_time = time.perf_counter()
+    stats = Counter()
+
+    with open_file(input_file, 'r', encoding='utf-8') as inp_fh, \
+            open_file(output_file, 'w', encoding='utf-8') as out_fh:
+
+        def write_result(result):
+            out_lines, chunk_stats = result
+            write_start_time = time.perf_counter()
+            out_fh.writelines(out_lines)
+            stats['write_time'] += time.perf_counter() - write_start_time
+            stats.update(chunk_stats)
+
+        chunks = read_chunks(inp_fh, chunk_size)
+        if workers > 1:
+            with Pool(workers) as pool:
+                # Keep a limited number of chunks in flight,
+                # so that memory use does not depend on the file size
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(clean_chunk, (chunk,)))
+                    if len(pending) >= 2 * workers:
+                        write_result(pending.popleft().get())
+                while pending:
+                    write_result(pending.popleft().get())
+        else:
+            for chunk in chunks:
+                write_result(clean_chunk(chunk))
 
-    # Read in source and target sentences
-    with open(input_file, 'r', encoding='utf-8') as inp_fh:
-        inp_lines = [line.strip() for line in inp_fh.readlines()]
-        docs, src_lines, tgt_lines = [], [], []
-        for line in inp_lines:
-            try:
-                d, s, t = line.split('__@delimeter@__')
-            except ValueError:
-                continue
-
-            docs.append(d)
-            src_lines.append(s.replace('\t', ' '))
-            tgt_lines.append(t.replace('\t', ' '))
-    # Filter out bad sentence pairs
-    out_docs, out_src, out_tgt = filter_lines(docs, src_lines, tgt_lines)
-
-    # Write result
-    with open(output_file, 'w', encoding='utf-8') as out_fh:
-        for i, doc in enumerate(out_docs):
-            out_fh.write('\t'.join([doc, out_src[i], out_tgt[i]]) + '\n')
+    report = make_report(input_file, stats, time.perf_counter() - start_time)
+    logging.info('Kept {0} of {1} lines ({2:.0f} lines/sec)'.format(
+        report['kept'], report['lines'], report['lines_per_sec']))
+    if stats_file:
+        with open(stats_file, 'w', encoding='utf-8') as stats_fh:
+            json.dump(report, stats_fh, indent=4)
+        logging.info('Statistics saved into {}'.format(stats_file))
 
     logging.info('Done')
+    return report
 
 
 if __name__ == '__main__':
@@ -98,8 +260,15 @@ if __name__ == '__main__':
                                         "__@delimeter@__src_sent"
                                         "__@delimeter@__tgt_sent")
     parser.add_argument("--output", help="Filename for cleaned data")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used for cleaning")
+    parser.add_argument("--chunk_size", type=int, default=100000,
+                        help="Number of lines cleaned by a process at a time")
+    parser.add_argument("--stats", default=None,
+                        help="Filename for cleaning statistics (JSON)")
 
     args = parser.parse_args()
 
     # Clean the files
-    filter_file(args.input, args.output)
+    filter_file(args.input, args.output, args.workers, args.chunk_size,
+                args.stats)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import gzip
+import shutil
+import hashlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extensions of compressed files
+COMPRESSION_EXTENSIONS = ('.gz', '.zst')
+# Worker threads of each zstandard writer (0: compress in the writing
+# thread), scripts may keep many writers open at the same time
+ZSTD_THREADS = 2
+
+
+def compression(filename):
+    """
+    Return the compression extension of filename
+    ('' for plain text files)
+    """
+    for ext in COMPRESSION_EXTENSIONS:
+        if filename.endswith(ext):
+            return ext
+    return ''
+
+
+def output_name(input_file, suffix):
+    """
+    Add suffix to the input filename before its compression extension,
+    e.g. corpus.docs.gz -> corpus.docs.test.gz
+    """
+    ext = compression(input_file)
+    return input_file[:len(input_file) - len(ext)] + suffix + ext
+
+
+def find_file(filename):
+    """
+    Return filename or, if it does not exist, the name
+    of an existing compressed version of it
+    """
+    if not os.path.exists(filename):
+        for ext in COMPRESSION_EXTENSIONS:
+            if os.path.exists(filename + ext):
+                return filename + ext
+    return filename
+
+
+def open_file(filename, mode='r', encoding='utf8', buffering=-1,
+              threads=ZSTD_THREADS):
+    """
+    Open a plain text, gzip (.gz) or zstandard (.zst) compressed file,
+    the compression is detected by the extension; zstandard files
+    are compressed with the given number of worker threads
+    (requires the zstandard package)
+    """
+    ext = compression(filename)
+    if not ext:
+        if 'b' in mode:
+            return open(filename, mode, buffering=buffering)
+        return open(filename, mode, encoding=encoding, buffering=buffering)
+
+    writing = 'w' in mode or 'a' in mode
+    if ext == '.gz':
+        fh = gzip.open(filename, ('ab' if 'a' in mode else 'wb')
+                       if writing else 'rb', compresslevel=6)
+    else:
+        if zstandard is None:
+            raise ImportError("Reading and writing {} requires the zstandard "
+                              "package".format(filename))
+        if writing:
+            fh = io.BufferedWriter(
+                zstandard.ZstdCompressor(threads=threads).stream_writer(
+                    open(filename, 'ab' if 'a' in mode else 'wb')))
+        else:
+            # Concatenated files consist of several frames
+            fh = io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(
+                    open(filename, 'rb'), read_across_frames=True))
+    if 'b' in mode:
+        return fh
+    return io.TextIOWrapper(fh, encoding=encoding)
+
+
+def decompress(filename):
+    """
+    Decompress a compressed file into a temporary plain file next to it
+    (e.g. for memory mapping), return the name of the plain file;
+    the copy needs as much disk space as the uncompressed data
+    """
+    plain_file = filename + '-plain'
+    with open_file(filename, 'rb') as in_fh, open(plain_file, 'wb') as out_fh:
+        shutil.copyfileobj(in_fh, out_fh, 1 << 20)
+    return plain_file
+
+
+def file_hash(filename, block_size=1 << 24):
+    """
+    SHA-1 of a file's contents, read a block at a time
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
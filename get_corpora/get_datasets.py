@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cleaning_docs
+import opustools_to_documents
+import separate_test_dev_train
+from corpus_io import output_name, file_hash
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+
+# Content hashes computed by this process,
+# by (filename, size, modification time)
+known_hashes = {}
+
+
+def file_info(filename):
+    """
+    Size, modification time and content hash of a file;
+    each version of a file is hashed at most once by a process
+    """
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime_ns)
+    if key not in known_hashes:
+        known_hashes[key] = file_hash(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': known_hashes[key]}
+
+
+def make_stamp(inputs, outputs, params):
+    """
+    Describe a stage run: its parameters and the sizes, modification
+    times and content hashes of its input and output files
+    """
+    return {'params': params,
+            'inputs': {filename: file_info(filename) for filename in inputs},
+            'outputs': {filename: file_info(filename)
+                        for filename in outputs}}
+
+
+def unchanged(filename, saved):
+    """
+    Compare a file with its file_info saved in a stamp: the content
+    is only hashed if the size is the same but the modification
+    time is not
+    """
+    if not isinstance(saved, dict) or not os.path.isfile(filename):
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != saved.get('size'):
+        return False
+    if stat.st_mtime_ns != saved.get('mtime_ns'):
+        return file_info(filename)['sha1'] == saved.get('sha1')
+    # the saved hash is still valid, make_stamp can reuse it
+    known_hashes[(filename, stat.st_size, stat.st_mtime_ns)] = saved['sha1']
+    return True
+
+
+def read_stamp(stamp_file):
+    """
+    Read a stamp file, return None if there is none
+    """
+    if not os.path.isfile(stamp_file):
+        return None
+    with open(stamp_file, 'r', encoding='utf8') as stamp_fh:
+        return json.load(stamp_fh)
+
+
+def up_to_date(stamp, inputs, outputs, params):
+    """
+    Check if the outputs were made from the same inputs with the same
+    parameters and have not been changed since
+    """
+    if stamp is None or stamp.get('params') != params:
+        return False
+    for group, filenames in (('inputs', inputs), ('outputs', outputs)):
+        saved = stamp.get(group, {})
+        if set(saved) != set(filenames) or \
+                not all(unchanged(filename, saved[filename])
+                        for filename in filenames):
+            return False
+    return True
+
+
+def write_stamp(stamp_file, stamp):
+    """
+    Save a stamp made by make_stamp
+    """
+    with open(stamp_file, 'w', encoding='utf8') as stamp_fh:
+        json.dump(stamp, stamp_fh, indent=4)
+
+
+def run_stage(name, action, inputs, outputs, params, force=False):
+    """
+    Call action() to make the outputs from the inputs, unless they are
+    up to date; a stamp file with the sizes, modification times
+    and content hashes is saved next to the first output
+    """
+    stamp_file = outputs[0] + '.stamp'
+    old_stamp = read_stamp(stamp_file)
+    if not force and up_to_date(old_stamp, inputs, outputs, params):
+        logging.info(f'{name}: {outputs[0]} is up to date, skipping')
+        # save new modification times of files with the same content,
+        # so that they are not hashed again next time
+        stamp = make_stamp(inputs, outputs, params)
+        if stamp != old_stamp:
+            write_stamp(stamp_file, stamp)
+        return
+    logging.info(f'{name}: making {outputs[0]}')
+    action()
+    write_stamp(stamp_file, make_stamp(inputs, outputs, params))
+
+
+def build_corpus(corpus, args):
+    """
+    Download a corpus from OPUS, clean it and separate it
+    into test, dev and train, skipping stages that are up to date
+    """
+    ext = '' if args.compression == 'none' else '.' + args.compression
+    docs_file = f'{args.out_dir}/{corpus}.{args.src}-{args.tgt}.docs{ext}'
+    clean_file = (f'{args.out_dir}/cl-{corpus}.{args.src}-{args.tgt}'
+                  f'.docs{ext}')
+    split_files = [output_name(clean_file, suffix) for suffix in
+                   ('.test', '.test-cl', '.dev', '.dev-cl', '.train')]
+
+    def download():
+        if args.in_process:
+            opustools_to_documents.opus_to_docs(corpus, args.src, args.tgt,
+                                                args.minsent, docs_file)
+            return
+        opus_file = opustools_to_documents.opus_read(corpus, args.src,
+                                                     args.tgt)
+        opustools_to_documents.convert_to_docs(args.minsent, opus_file,
+                                               docs_file, corpus,
+                                               args.src, args.tgt)
+
+    run_stage('download', download, [], [docs_file],
+              {'corpus': corpus, 'src': args.src, 'tgt': args.tgt,
+               'minsent': args.minsent, 'in_process': args.in_process},
+              args.force)
+    run_stage('clean',
+              lambda: cleaning_docs.filter_file(docs_file, clean_file),
+              [docs_file], [clean_file], {}, args.force)
+    run_stage('split',
+              lambda: separate_test_dev_train.split_file(
+                  clean_file, args.test_size, args.dev_size,
+                  args.train_size),
+              [clean_file], split_files,
+              {'test_size': args.test_size, 'dev_size': args.dev_size,
+               'train_size': args.train_size}, args.force)
+    return corpus
+
+
+def make_argument_parser():
+    parser = ArgumentParser(description="""Download corpora from OPUS,
+    clean them and make train, dev and test sets, processing
+    the corpora in parallel""")
+    parser.add_argument("--corpora", nargs='+',
+                        default=['Europarl', 'OpenSubtitles',
+                                 'JRC-Acquis', 'EMEA'],
+                        help="Corpus names")
+    parser.add_argument("--src", default='en', help="Source lang")
+    parser.add_argument("--tgt", default='et', help="Target lang")
+    parser.add_argument("--out_dir", default='da-corpora',
+                        help="Directory to save the results into")
+    parser.add_argument("--minsent", type=int, default=5,
+                        help="Minimum number of sentence pairs in document")
+    parser.add_argument("--test_size", help="Min size of test set",
+                        type=int, default=3000)
+    parser.add_argument("--dev_size", help="Min size of dev set",
+                        type=int, default=3000)
+    parser.add_argument("--train_size", help="Approx size of train set",
+                        type=int, default=500000)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of corpora processed at the same time "
+                             "(all by default)")
+    parser.add_argument("--in_process", action='store_true', default=False,
+                        help="Read the corpora with the opustools Python API "
+                             "instead of writing the aligned files")
+    parser.add_argument("--compression", choices=['none', 'gz', 'zst'],
+                        default='none',
+                        help="Compression of the documents files and of "
+                             "the test, dev and train sets (zst requires "
+                             "the zstandard package)")
+    parser.add_argument("--force", action='store_true', default=False,
+                        help="Run all stages, even if their outputs "
+                             "are up to date")
+
+    return parser
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    args = make_argument_parser().parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    with ProcessPoolExecutor(args.workers or len(args.corpora)) as executor:
+        futures = [executor.submit(build_corpus, corpus, args)
+                   for corpus in args.corpora]
+        for future in as_completed(futures):
+            logging.info(f'Finished {future.result()}')
+
+    logging.info('Done')
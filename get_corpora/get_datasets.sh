@@ -3,19 +3,11 @@
 srclang=en
 tgtlang=et
 
-mkdir da-corpora
-
-for corpus in Europarl OpenSubtitles JRC-Acquis EMEA
-do
- # Download corpora from OPUS
- python opustools_to_documents.py --corpus $corpus --src $srclang --tgt $tgtlang --filename da-corpora/$corpus.$srclang-$tgtlang.docs --minsent 5
- 
- # Basic cleaning
- python cleaning_docs.py --input da-corpora/$corpus.$srclang-$tgtlang.docs --output da-corpora/cl-$corpus.$srclang-$tgtlang.docs
- 
- # Separate into test, dev and train in a fair way:
- # whole documents are written into sets,
- # the clean test and dev will not contain sentence pairs
- # that have exact matches in other sets
- python separate_test_dev_train.py --input da-corpora/cl-$corpus.$srclang-$tgtlang.docs --test_size 3000 --dev_size 3000 --train_size 500000
-done
+# Download corpora from OPUS, do basic cleaning and separate into
+# test, dev and train in a fair way:
+# whole documents are written into sets,
+# the clean test and dev will not contain sentence pairs
+# that have exact matches in other sets.
+# The corpora are processed in parallel, stages whose outputs
+# are up to date are skipped
+python get_datasets.py --corpora Europarl OpenSubtitles JRC-Acquis EMEA --src $srclang --tgt $tgtlang --out_dir da-corpora --minsent 5 --test_size 3000 --dev_size 3000 --train_size 500000
@@ -3,27 +3,45 @@
 
 import os
 from argparse import ArgumentParser
+from itertools import groupby
 import shutil
-import re
+import time
 import logging
 import opustools
+from opustools.formatting import (check_lang_conf_type, pair_format_type,
+                                  sentence_format_type)
+
+import cleaning_docs
+from corpus_io import open_file
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
+# Buffer size of the output file
+BUFFER_SIZE = 1 << 20
+# Delimiter between the fields of the output lines
+DELIMITER = '__@delimeter@__'
+# First opustools version with the OpusRead internals
+# that read_opus_pairs uses
+MIN_OPUSTOOLS_VERSION = '1.9.0'
+
 
-def opus_read(corpus, src, tgt, keep=False):
+def opus_read(corpus, src, tgt, keep=False, dl_dir=None):
     """
     Download corpora from OPUS using the opustools package
-    (Moses format, include original filenames)
+    (Moses format, include original filenames); a given dl_dir
+    is kept, the default one is removed unless keep is True
     """
     logging.info("Downloading files from OPUS")
-    dl_dir = '{0}-{1}-{2}-dir-temp'.format(corpus, src, tgt)
+    if dl_dir is not None:
+        keep = True
+    else:
+        dl_dir = '{0}-{1}-{2}-dir-temp'.format(corpus, src, tgt)
     opus_out_file = '{0}-{1}-{2}-opus-aligned'.format(corpus, src, tgt)
     os.system("""opus_read -d {0} -s {1} -t {2} -p raw -w {3} -wm moses -dl {4} -pn -ln -q -cm '__@delimeter@__'""".
               format(corpus, src, tgt, opus_out_file, dl_dir))
     if not keep:
-        shutil.rmtree('{0}-{1}-{2}-dir-temp'.format(corpus, src, tgt))
+        shutil.rmtree(dl_dir)
     return opus_out_file
 
 
@@ -34,41 +52,161 @@ def convert_to_docs(min_sent, input_filename, output_filename,
     "file_id__@delimeter@__tsrc_sent__@delimeter@__tgt_sent",
     where file_id is corpus_srclang_tgtlang_docnumber
     """
-    docs_count, lines_count = 0, 0
-    with open(input_filename, 'r', encoding='utf8') as in_fh,\
-            open(output_filename, 'w', encoding='utf8') as out_fh:
-        logging.info("Converting to file_id__@delimeter@__tsrc_sent"
-                     "__@delimeter@__tgt_sent format")
-        current_doc = []
-        for line in in_fh.readlines():
-            if not line.strip():
-                continue
-            elif re.fullmatch("^<fromDoc>(.+)</fromDoc>$", line.strip()):
-                if len(current_doc) >= min_sent:
-                    out_fh.writelines(["{0}_{1}_{2}_{3}__@delimeter@__{4}\n"
-                                      .format(corpus, src_lang, tgt_lang,
-                                              docs_count, pair)
-                                       for pair in current_doc])
-                    docs_count += 1
-                    lines_count += len(current_doc)
-                current_doc = []
-                # src_doc = re.fullmatch("^<fromDoc>(.+)</fromDoc>$",
-                #                        line.strip()).group(1)
-            elif re.fullmatch("^<toDoc>(.+)</toDoc>$", line.strip()):
-                continue
-                # tgt_doc = re.fullmatch("^<toDoc>(.+)</toDoc>$",
-                #                        line.strip()).group(1)
-            else:
-                current_doc.append(line.strip())
+    logging.info("Converting to file_id__@delimeter@__tsrc_sent"
+                 "__@delimeter@__tgt_sent format")
+    with open_file(input_filename, 'r', encoding='utf8') as in_fh:
+        write_docs(read_aligned_pairs(in_fh), min_sent, output_filename,
+                   corpus, src_lang, tgt_lang)
     if not keep:
         if os.path.exists(input_filename):
             os.remove(input_filename)
-    logging.info("Wrote {0} docs, {1} lines into {2}".format(docs_count,
-                                                             lines_count,
-                                                             output_filename))
+
+
+def read_aligned_pairs(in_fh):
+    """
+    Read an aligned file written by opus_read (Moses format with
+    <fromDoc> and <toDoc> tags), yield (doc_number, pair) for each
+    sentence pair, where pair is "src_sent__@delimeter@__tgt_sent"
+    and doc_number counts the <fromDoc> tags
+    """
+    doc_number = -1
+    for line in in_fh:
+        line = line.strip()
+        if not line or is_tag(line, '<toDoc>', '</toDoc>'):
+            continue
+        elif is_tag(line, '<fromDoc>', '</fromDoc>'):
+            doc_number += 1
+        else:
+            yield doc_number, line
+
+
+def is_tag(line, opening, closing):
+    """
+    Check if the (stripped) line is an OPUS tag with some content,
+    e.g. <fromDoc>filename</fromDoc>
+    """
+    return (line.startswith(opening) and line.endswith(closing) and
+            len(line) > len(opening) + len(closing))
+
+
+def in_process_supported():
+    """
+    Check if the installed opustools has the generator of sentence
+    pairs with document names that read_opus_pairs uses
+    (OpusRead._iter_pairs, not a public API)
+    """
+    return hasattr(opustools.OpusRead, '_iter_pairs')
+
+
+def read_opus_pairs(corpus, src, tgt, dl_dir):
+    """
+    Read a corpus from OPUS in this process using the opustools package
+    (version MIN_OPUSTOOLS_VERSION or later, see in_process_supported),
+    downloading the files into dl_dir unless they are already there;
+    yield (doc_number, pair) for each sentence pair like
+    read_aligned_pairs does for the file written by opus_read
+    """
+    logging.info("Reading files from OPUS")
+    reader = opustools.OpusRead(directory=corpus, source=src, target=tgt,
+                                preprocess='raw',
+                                leave_non_alignments_out=True,
+                                suppress_prompts=True, download_dir=dl_dir)
+    # Format the pairs like OpusRead.yieldPairs, which does not give
+    # the document names; _iter_pairs calls doc_start for each
+    # document chunk where opus_read writes a <fromDoc> tag
+    format_pair = pair_format_type(
+        'yield_tuple', reader.switch_langs,
+        check_lang_conf_type(reader.lang_filters)[0], False,
+        sentence_format_type('yield_tuple', [src, tgt]))
+    doc_numbers = [-1]
+
+    def doc_start(src_doc_name, tgt_doc_name):
+        doc_numbers[0] += 1
+
+    try:
+        for src_result, tgt_result, _, _, _ in reader._iter_pairs(
+                'yield_tuple', format_pair, on_doc_start=doc_start):
+            # the same line as opus_read -wm moses writes
+            yield doc_numbers[0], (
+                src_result.rstrip('\n').replace('\n', ' ') + DELIMITER +
+                tgt_result.rstrip('\n').replace('\n', ' ')).strip()
+    finally:
+        reader.alignmentParser.bp.close_document()
+        reader.of_handler.close_zipfiles()
+
+
+def write_docs(pairs, min_sent, output_filename, corpus, src_lang, tgt_lang,
+               clean=False):
+    """
+    Write (doc_number, pair) records, where pair is
+    "src_sent__@delimeter@__tgt_sent", into output_filename in format
+    "file_id__@delimeter@__src_sent__@delimeter@__tgt_sent",
+    skipping documents with less than min_sent pairs;
+    if clean, bad sentence pairs are removed like in cleaning_docs
+    and the result is written in format "doc_id\\tsrc_sent\\ttgt_sent"
+    """
+    docs_count, lines_count = 0, 0
+    start_time = time.time()
+    doc_prefix = "{0}_{1}_{2}_".format(corpus, src_lang, tgt_lang)
+    with open_file(output_filename, 'w', encoding='utf8',
+                   buffering=BUFFER_SIZE) as out_fh:
+        for _, doc_pairs in groupby(pairs, key=lambda record: record[0]):
+            current_doc = [pair for _, pair in doc_pairs]
+            if len(current_doc) < min_sent:
+                continue
+            file_id = doc_prefix + str(docs_count)
+            doc_lines = [file_id + DELIMITER + pair + "\n"
+                         for pair in current_doc]
+            if clean:
+                doc_lines, _ = cleaning_docs.clean_chunk(doc_lines)
+            out_fh.writelines(doc_lines)
+            docs_count += 1
+            lines_count += len(doc_lines)
+            if docs_count % 100000 == 0:
+                logging.info("Converted {0} docs ({1:.0f} docs/sec)".format(
+                    docs_count, docs_count / (time.time() - start_time)))
+    elapsed = time.time() - start_time
+    logging.info("Wrote {0} docs, {1} lines into {2} ({3:.0f} docs/sec)"
+                 .format(docs_count, lines_count, output_filename,
+                         docs_count / elapsed if elapsed else 0))
+
+
+def opus_to_docs(corpus, src, tgt, min_sent, output_filename, clean=False,
+                 dl_dir=None, keep=False):
+    """
+    Read a corpus from OPUS and write it into output_filename
+    in one streaming pipeline, see read_opus_pairs and write_docs;
+    with an older opustools, the corpus is read from the file written
+    by opus_read instead
+    """
+    if not in_process_supported():
+        logging.warning(f"Reading OPUS in process requires opustools "
+                        f"{MIN_OPUSTOOLS_VERSION} or later, "
+                        f"using opus_read instead")
+        opus_file = opus_read(corpus, src, tgt, keep, dl_dir)
+        with open_file(opus_file, 'r', encoding='utf8') as in_fh:
+            write_docs(read_aligned_pairs(in_fh), min_sent,
+                       output_filename, corpus, src, tgt, clean)
+        if not keep and os.path.exists(opus_file):
+            os.remove(opus_file)
+        return
+    remove_dl_dir = dl_dir is None and not keep
+    if dl_dir is None:
+        dl_dir = '{0}-{1}-{2}-dir-temp'.format(corpus, src, tgt)
+    try:
+        write_docs(read_opus_pairs(corpus, src, tgt, dl_dir), min_sent,
+                   output_filename, corpus, src, tgt, clean)
+    finally:
+        if remove_dl_dir and os.path.isdir(dl_dir):
+            shutil.rmtree(dl_dir)
 
 
 def main(args):
+    if args.in_process:
+        opus_to_docs(args.corpus, args.src, args.tgt, args.minsent,
+                     args.filename, args.clean, args.download_dir,
+                     args.keepfiles)
+        return
     opus_file = opus_read(args.corpus, args.src, args.tgt, args.keepfiles)
     convert_to_docs(args.minsent, opus_file, args.filename,
                     args.corpus, args.src, args.tgt, args.keepfiles)
@@ -84,12 +222,24 @@ if __name__ == '__main__':
     parser.add_argument("--tgt", required=True, type=str,
                         help="Target lang")
     parser.add_argument("--filename", type=str, default='corpus',
-                        help="Filename to save the result into")
+                        help="""Filename to save the result into,
+                        compressed if it ends with .gz or .zst""")
     parser.add_argument("--minsent", type=int, default=1,
                         help="Minimum number of sentence pairs in document")
     parser.add_argument("--keepfiles", action='store_true',
                         default=False, help="""Keep the raw and aligned files
                                                downloaded from OPUS""")
+    parser.add_argument("--in_process", action='store_true',
+                        default=False, help="""Read the corpus with the
+                        opustools Python API (version 1.9.0 or later)
+                        and convert it as it is read, without writing
+                        the aligned file""")
+    parser.add_argument("--clean", action='store_true',
+                        default=False, help="""With --in_process, also
+                        remove bad sentence pairs like cleaning_docs.py""")
+    parser.add_argument("--download_dir", type=str, default=None,
+                        help="""With --in_process, directory with (or for)
+                        the files downloaded from OPUS, it is kept""")
 
     arguments = parser.parse_args()
 
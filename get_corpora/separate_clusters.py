@@ -1,109 +1,237 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
+import shutil
 import numpy as np
 import logging
+from itertools import islice
+from contextlib import ExitStack
 from argparse import ArgumentParser
+from corpus_io import open_file, find_file, compression
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
+# Buffer size of the cluster files
+BUFFER_SIZE = 1 << 20
+# Number of lines whose clusters are generated, read or separated at a time
+BLOCK_LINES = 1 << 16
+
+
+def count_lines(filename):
+    """
+    Count lines in a (possibly compressed) file, reading it in large blocks
+    """
+    n_lines, last_block = 0, b''
+    with open_file(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(BUFFER_SIZE), b''):
+            n_lines += block.count(b'\n')
+            last_block = block
+    # the last line may not end with a newline
+    if last_block and not last_block.endswith(b'\n'):
+        n_lines += 1
+    return n_lines
+
+
+def index_dtype(n_clusters):
+    """
+    Smallest unsigned integer type that can hold all cluster numbers
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n_clusters <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
 
 def make_random_indices(loc, input_files, src_lang, tgt_lang,
-                        cluster_mode_name='rand_clusters', n_clusters=4):
+                        cluster_mode_name='rand_clusters', n_clusters=4,
+                        seed=0, binary=False):
+    """
+    Assign a random cluster to each line of the input files and save
+    the cluster numbers into FILENAME.{cluster_mode_name}_{n_clusters}.txt
+    (and into a binary .npy array of the same name if binary is True,
+    then the .npy filenames are returned);
+    with the same seed, the same clusters are generated
+    """
+    logging.info(f"Generating random clusters with seed {seed}")
+    rng = np.random.default_rng(seed)
+    dtype = index_dtype(n_clusters)
     indices_filenames = []
     # iterate over input files
     for filename in input_files:
-        # open the input files to read lines from
-        # and a file into which to write the cluster indices
-        with open(f'{loc}/{filename}.{src_lang}',
-                  'r', encoding='utf8') as in_src_fh, \
-                open(f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}.txt',
-                     'w', encoding='utf8') as out_cluster_fh:
-            # iterate over input lines
-            for src_line in in_src_fh:
-                # generate random cluster number for current line
-                rand_cl = str(np.random.choice(range(n_clusters)))
-                # save this cluster number
-                out_cluster_fh.write(str(rand_cl) + '\n')
-        indices_filenames.append(f'{filename}.{cluster_mode_name}_'
-                                 f'{n_clusters}.txt')
+        n_lines = count_lines(find_file(f'{loc}/{filename}.{src_lang}'))
+        indices_name = f'{filename}.{cluster_mode_name}_{n_clusters}'
+        if binary:
+            binary_indices = np.lib.format.open_memmap(
+                f'{loc}/{indices_name}.npy', mode='w+',
+                dtype=dtype, shape=(n_lines,))
+        # open a file into which to write the cluster indices
+        with open(f'{loc}/{indices_name}.txt', 'w', encoding='utf8',
+                  buffering=BUFFER_SIZE) as out_cluster_fh:
+            # generate random cluster numbers for a block of lines at a time
+            for start in range(0, n_lines, BLOCK_LINES):
+                # int64 draws do not depend on the block size
+                rand_cl = rng.integers(
+                    n_clusters, size=min(BLOCK_LINES, n_lines - start),
+                    dtype=np.int64).astype(dtype)
+                # save these cluster numbers
+                out_cluster_fh.write(
+                    '\n'.join(map(str, rand_cl.tolist())) + '\n')
+                if binary:
+                    binary_indices[start:start + len(rand_cl)] = rand_cl
+        if binary:
+            binary_indices.flush()
+            del binary_indices
+            indices_filenames.append(f'{indices_name}.npy')
+        else:
+            indices_filenames.append(f'{indices_name}.txt')
 
     return indices_filenames
 
 
+def read_indices(filename, block_size=BLOCK_LINES):
+    """
+    Read cluster indices from a text file (one number per line)
+    or from a memory-mapped binary .npy file,
+    yield them in blocks of block_size as NumPy arrays
+    """
+    if filename.endswith('.npy'):
+        indices = np.load(filename, mmap_mode='r')
+        for start in range(0, len(indices), block_size):
+            yield indices[start:start + block_size]
+    else:
+        with open_file(filename, 'r', encoding='utf8') as fh:
+            while True:
+                block = [int(line) for line in islice(fh, block_size)]
+                if not block:
+                    break
+                yield np.array(block, dtype=np.int64)
+
+
+def save_binary_indices(loc, indices_file, n_clusters):
+    """
+    Save cluster indices from a text file into a binary .npy file
+    with the same name, return the name of the new file
+    """
+    binary_file = indices_file.rsplit('.', 1)[0] + '.npy'
+    binary_indices = np.lib.format.open_memmap(
+        f'{loc}/{binary_file}', mode='w+', dtype=index_dtype(n_clusters),
+        shape=(count_lines(f'{loc}/{indices_file}'),))
+    start = 0
+    for block in read_indices(f'{loc}/{indices_file}'):
+        binary_indices[start:start + len(block)] = block
+        start += len(block)
+    binary_indices.flush()
+    return binary_file
+
+
+def cluster_sizes(loc, indices_file, n_clusters):
+    """
+    Count the lines in each cluster
+    """
+    sizes = np.zeros(n_clusters, dtype=np.int64)
+    for block in read_indices(f'{loc}/{indices_file}'):
+        sizes += np.bincount(block, minlength=n_clusters)
+    return sizes
+
+
+def separate_block(block, src_lines, tgt_lines, out_fhs):
+    """
+    Write a block of src and tgt lines into the files of their clusters
+    (block holds the cluster number of each line), one cluster at a time
+    """
+    # line positions grouped by cluster, in the original order
+    order = np.argsort(block, kind='stable').tolist()
+    ends = np.cumsum(np.bincount(block, minlength=len(out_fhs))).tolist()
+    start = 0
+    for (out_src_fh, out_tgt_fh), end in zip(out_fhs, ends):
+        positions = order[start:end]
+        out_src_fh.writelines(map(src_lines.__getitem__, positions))
+        out_tgt_fh.writelines(map(tgt_lines.__getitem__, positions))
+        start = end
+
+
 def separate(loc, input_files, src_lang, tgt_lang,
              indices_files, cluster_mode_name, n_clusters=4):
+    """
+    Write the parallel lines of each input file into the files
+    of their clusters; the input files and the indices file must
+    have the same number of lines
+    """
     # iterate over input files
     for file_num, filename in enumerate(input_files):
-        # create a dictionary of src ang tgt lines in each cluster
-        sep_lines = {str(i): {'src': [], 'tgt': []}
-                     for i in range(n_clusters)}
-        # open the input files to read lines from
-        # and a file into which to write the cluster indices
-        with open(f'{loc}/{filename}.{src_lang}',
-                  'r', encoding='utf8') as in_src_fh, \
-                open(f'{loc}/{filename}.{tgt_lang}',
-                     'r', encoding='utf8') as in_tgt_fh, \
-                open(f'{loc}/{indices_files[file_num]}',
-                     'r', encoding='utf8') as in_cluster_fh:
-            # iterate over input lines
-            for src_line in in_src_fh:
-                tgt_line = in_tgt_fh.readline()
-                src, tgt = src_line.strip(), tgt_line.strip()
-                # read the cluster name from file
-                rand_cl = in_cluster_fh.readline().strip()
-                # add src and tgt lines to the corresponding dictionary
-                sep_lines[rand_cl]['src'].append(src)
-                sep_lines[rand_cl]['tgt'].append(tgt)
-
-        # iterate over clusters, write each cluster into a separate file
-        for cluster in [str(i) for i in range(n_clusters)]:
-            # open the src output file
-            with open(
-                    f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}_'
-                    f'cluster{cluster}.{src_lang}',
-                    'w', encoding='utf8') as out_src_fh:
-                # write all src lines from the dictionary
-                out_src_fh.writelines(
-                    [line + '\n' for line in sep_lines[cluster]['src']])
-            # same for tgt
-            with open(
-                    f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}_'
-                    f'cluster{cluster}.{tgt_lang}',
-                    'w', encoding='utf8') as out_tgt_fh:
-                out_tgt_fh.writelines(
-                    [line + '\n' for line in sep_lines[cluster]['tgt']])
+        # input files may be compressed (FILENAME.LANG.gz or .zst),
+        # then the cluster files are compressed the same way
+        in_src_file = find_file(f'{loc}/{filename}.{src_lang}')
+        in_tgt_file = find_file(f'{loc}/{filename}.{tgt_lang}')
+        ext = compression(in_src_file)
+        with ExitStack() as stack:
+            # open a src and a tgt output file for each cluster,
+            # lines are written into them as soon as they are read
+            # (compressed without extra threads, there are many files)
+            out_fhs = []
+            for cluster in range(n_clusters):
+                out_fhs.append(tuple(
+                    stack.enter_context(open_file(
+                        f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}_'
+                        f'cluster{cluster}.{lang}{ext}',
+                        'w', encoding='utf8', buffering=BUFFER_SIZE,
+                        threads=0))
+                    for lang in (src_lang, tgt_lang)))
+            # open the input files to read lines from
+            in_src_fh = stack.enter_context(open_file(
+                in_src_file, 'r', encoding='utf8'))
+            in_tgt_fh = stack.enter_context(open_file(
+                in_tgt_file, 'r', encoding='utf8'))
+            indices_file = f'{loc}/{indices_files[file_num]}'
+            # read the cluster numbers and the lines they belong to
+            # in blocks
+            n_lines = 0
+            for block in read_indices(indices_file, BLOCK_LINES):
+                src_lines = [line.strip() + '\n'
+                             for line in islice(in_src_fh, len(block))]
+                tgt_lines = [line.strip() + '\n'
+                             for line in islice(in_tgt_fh, len(block))]
+                n_lines += len(block)
+                if len(src_lines) < len(block) or \
+                        len(tgt_lines) < len(block):
+                    raise ValueError(
+                        f'{in_src_file} or {in_tgt_file} has fewer lines '
+                        f'than {indices_file} has cluster numbers')
+                if len(block) and block.max() >= n_clusters:
+                    raise ValueError(
+                        f'{indices_file} has cluster number '
+                        f'{block.max()} with {n_clusters} clusters')
+                separate_block(block, src_lines, tgt_lines, out_fhs)
+            if next(in_src_fh, None) is not None or \
+                    next(in_tgt_fh, None) is not None:
+                raise ValueError(f'{in_src_file} or {in_tgt_file} has more '
+                                 f'lines than the {n_lines} cluster numbers '
+                                 f'in {indices_file}')
 
 
 def restore_cluster_order(loc, input_files, cluster_mode_name,
                           src_lang, tgt_lang, n_clusters=4):
     # iterate over input lines
     for filename in input_files:
-        # create src and tgt lines where we will save lines in cluster order
-        # (first the whole cluster 0, then 1, etc.)
-        with open(f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}_'
-                  f'clusterorder.{src_lang}',
-                  'w', encoding='utf8') as src_clusterorder_fh, \
-                open(f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}_'
-                     f'clusterorder.{tgt_lang}',
-                     'w', encoding='utf8') as tgt_clusterorder_fh:
-            # iterate over clusters
-            for cluster in [str(i) for i in range(n_clusters)]:
-                # open the cluster file and write all of its lines into
-                # the cluster order file
-                with open(
-                        f'{loc}/{filename}.{cluster_mode_name}_'
-                        f'{n_clusters}_cluster{cluster}.{src_lang}',
-                        'r', encoding='utf8') as cluster_src_fh:
-                    for line in cluster_src_fh:
-                        src_clusterorder_fh.write(line.strip() + '\n')
-                with open(
-                        f'{loc}/{filename}.{cluster_mode_name}_'
-                        f'{n_clusters}_cluster{cluster}.{tgt_lang}',
-                        'r', encoding='utf8') as cluster_tgt_fh:
-                    for line in cluster_tgt_fh:
-                        tgt_clusterorder_fh.write(line.strip() + '\n')
+        # cluster files are compressed like the input files,
+        # compressed files can also be concatenated byte by byte
+        ext = compression(find_file(f'{loc}/{filename}.{src_lang}'))
+        for lang in (src_lang, tgt_lang):
+            # create a file where we will save lines in cluster order
+            # (first the whole cluster 0, then 1, etc.)
+            with open(f'{loc}/{filename}.{cluster_mode_name}_{n_clusters}_'
+                      f'clusterorder.{lang}{ext}', 'wb') as clusterorder_fh:
+                # iterate over clusters
+                for cluster in [str(i) for i in range(n_clusters)]:
+                    # copy the whole cluster file into the cluster order
+                    # file, its lines are already stripped
+                    with open(f'{loc}/{filename}.{cluster_mode_name}_'
+                              f'{n_clusters}_cluster{cluster}.{lang}{ext}',
+                              'rb') as cluster_fh:
+                        shutil.copyfileobj(cluster_fh, clusterorder_fh,
+                                           BUFFER_SIZE)
 
 
 def make_argument_parser():
@@ -111,11 +239,14 @@ def make_argument_parser():
     parser.add_argument("--path_to_files", help="Path to input files location")
     parser.add_argument("--input_files", nargs='+',
                         help="List of input filenames, "
-                             "without the language extensions")
+                             "without the language extensions "
+                             "(files may be compressed: FILENAME.LANG.gz "
+                             "or FILENAME.LANG.zst)")
     parser.add_argument("--indices", nargs='+',
                         help="List of filenames containing cluster indices, "
                              "in the same order as the input parallel files "
-                             "they correspond to")
+                             "they correspond to (text files with one number "
+                             "per line or binary .npy arrays)")
     parser.add_argument("--cluster_mode_name", type=str,
                         help="String identifying the cluster type "
                              "(e.g. rand_clusters), will appear in "
@@ -129,6 +260,17 @@ def make_argument_parser():
     parser.add_argument("--random", action='store_true', default=False,
                         help="With this flag, random cluster "
                              "numbers will be generated")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for generating random cluster numbers")
+    parser.add_argument("--binary_indices", action='store_true',
+                        default=False,
+                        help="With this flag, cluster numbers (random or "
+                             "given in text files) are also saved as a "
+                             "binary array (.npy), which is used "
+                             "for separating")
+    parser.add_argument("--sizes_only", action='store_true', default=False,
+                        help="With this flag, only the number of lines "
+                             "in each cluster is shown")
 
     return parser
 
@@ -148,7 +290,9 @@ if __name__ == '__main__':
                                             src_lang=args.src_lang,
                                             tgt_lang=args.tgt_lang,
                                             cluster_mode_name=mode_name,
-                                            n_clusters=args.n_clusters)
+                                            n_clusters=args.n_clusters,
+                                            seed=args.seed,
+                                            binary=args.binary_indices)
     else:
         logging.info("Separating according to given indices")
         ind_file_list = args.indices
@@ -156,6 +300,20 @@ if __name__ == '__main__':
 
     assert(len(ind_file_list) == len(args.input_files))
 
+    if args.binary_indices and not args.random:
+        ind_file_list = [ind_file if ind_file.endswith('.npy') else
+                         save_binary_indices(args.path_to_files, ind_file,
+                                             args.n_clusters)
+                         for ind_file in ind_file_list]
+        logging.info(f"Binary indices saved into {ind_file_list}")
+
+    if args.sizes_only:
+        for ind_file in ind_file_list:
+            sizes = cluster_sizes(args.path_to_files, ind_file,
+                                  args.n_clusters)
+            logging.info(f"Cluster sizes in {ind_file}: {sizes.tolist()}")
+        sys.exit(0)
+
     # separate into random clusters
     separate(loc=args.path_to_files, input_files=args.input_files,
              src_lang=args.src_lang, tgt_lang=args.tgt_lang,
@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mmap
 import numpy as np
 import logging
-from bisect import bisect_left
+from io import BytesIO
+from collections import Counter
 from argparse import ArgumentParser
+from corpus_io import open_file, output_name, compression
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
@@ -15,7 +18,7 @@ def count_lines_and_docs(input_file):
     """
     Count how many lines and documents the file contains
     """
-    with open(input_file, 'r', encoding='utf8') as fh:
+    with open_file(input_file, 'r', encoding='utf8') as fh:
         line_count = 0
         for line in fh:
             line_count += 1
@@ -38,47 +41,68 @@ def shuffle_indices(n_docs):
 
 def find_doc_spans(input_file):
     """
-    Find the start and end position of each doc in the original file
+    Find the start position (in bytes) of each doc in the original file;
+    doc i spans bytes doc_offsets[i]:doc_offsets[i + 1]
     """
     # logging.info('Finding document spans')
-    doc_spans = {}
-    with open(input_file, 'r', encoding='utf8') as fh:
+    doc_offsets = []
+    with open_file(input_file, 'rb') as fh:
         doc_num = None
-        for i, line in enumerate(fh):
-            line_doc_num = int(line.split('\t')[0].split('_')[-1])
+        position = 0
+        for line in fh:
+            line_doc_num = int(line.split(b'\t', 1)[0].split(b'_')[-1])
             # If doc id in line is different than the current doc id,
             # then this line starts a new doc
             if line_doc_num != doc_num:
-                doc_spans[line_doc_num] = [None, None]
-                current_doc_start = i
-                if i > 0:
-                    # The previous line ends the previous doc
-                    prev_doc_end = i
-                    doc_spans[line_doc_num - 1][1] = prev_doc_end
-                # Save start of current doc
-                doc_spans[line_doc_num][0] = current_doc_start
+                doc_offsets.append(position)
                 doc_num = line_doc_num
+            position += len(line)
         # Save end of the last doc
-        doc_spans[line_doc_num][1] = i + 1
-    return doc_spans
+        doc_offsets.append(position)
+    return np.array(doc_offsets, dtype=np.int64)
 
 
 def reorder(input_file, shuf_indices, doc_spans):
     """
     Write documents in shuffled order into file input_file+'-reord'
+    (doc_spans are positions in the uncompressed data);
+    a compressed file is read once in its own order and each document
+    is written at its shuffled position, so that no decompressed copy
+    of the input is needed
     """
     # logging.info('Reordering documents')
-    with open(input_file, 'r', encoding='utf8') as fh:
-        inp_lines = [line for line in fh.readlines()]
-    with open(input_file + '-reord', 'w', encoding='utf8') as reord_fh:
-        written_docs = 0
+    if compression(input_file):
+        doc_sizes = np.diff(doc_spans)
+        # start of each document in the reordered file
+        targets = np.empty_like(doc_sizes)
+        targets[shuf_indices] = (np.cumsum(doc_sizes[shuf_indices]) -
+                                 doc_sizes[shuf_indices])
+        with open_file(input_file, 'rb') as fh, \
+                open(input_file + '-reord', 'wb') as reord_fh:
+            for target, size in zip(targets.tolist(), doc_sizes.tolist()):
+                reord_fh.seek(target)
+                reord_fh.write(fh.read(size))
+        return input_file + '-reord'
+    with open(input_file, 'rb') as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as inp_mm, \
+            open(input_file + '-reord', 'wb') as reord_fh:
         for ind in shuf_indices:
-            written_docs += 1
-            reord_fh.writelines(inp_lines[doc_spans[ind][0]:
-                                          doc_spans[ind][1]])
+            reord_fh.write(inp_mm[doc_spans[ind]:doc_spans[ind + 1]])
     return input_file + '-reord'
 
 
+def read_doc(reord_fh, doc_spans):
+    """
+    Read the next whole document from the reordered file
+    """
+    line = reord_fh.readline()
+    current_doc_id = int(line.split(b'\t', 1)[0].split(b'_')[-1])
+    current_doc_size = (doc_spans[current_doc_id + 1] -
+                        doc_spans[current_doc_id])
+    rest = reord_fh.read(current_doc_size - len(line))
+    return [line] + BytesIO(rest).readlines()
+
+
 def write_test_dev_train(reord_file, input_file, doc_spans,
                          test_size=3000, dev_size=3000, train_size=1000000):
     """
@@ -88,9 +112,8 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
     of the lines are written into train until train_size is exceeded
     """
 
-    # Read in all lines to check for overlapping later
-    with open(reord_file, 'r', encoding='utf8') as reord_fh:
-        all_lines = [line for line in reord_fh.readlines()]
+    # Index all lines to check for overlapping later
+    overlap_index = build_overlap_index(reord_file)
 
     logging.info('Separating test, dev and train')
     # Keep count of clean test, dev and train lines
@@ -100,38 +123,29 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
     docs_count, n_test_docs, n_dev_docs, n_train_docs = 0, 0, 0, 0
 
     # Open reordered docs file for reading and all output files for writing
-    with open(reord_file, 'r', encoding='utf8') as reord_fh, \
-            open(input_file + '.test', 'w', encoding='utf8') as test_fh, \
-            open(input_file + '.dev', 'w', encoding='utf8') as dev_fh, \
-            open(input_file + '.train', 'w', encoding='utf8') as train_fh, \
-            open(input_file + '.dev-cl', 'w', encoding='utf8') as cl_dev_fh, \
-            open(input_file + '.test-cl', 'w', encoding='utf8') as cl_test_fh:
-        for doc in range(len(doc_spans)):
+    with open(reord_file, 'rb') as reord_fh, \
+            open_file(output_name(input_file, '.test'), 'wb') as test_fh, \
+            open_file(output_name(input_file, '.dev'), 'wb') as dev_fh, \
+            open_file(output_name(input_file, '.train'), 'wb') as train_fh, \
+            open_file(output_name(input_file, '.dev-cl'), 'wb') as cl_dev_fh, \
+            open_file(output_name(input_file, '.test-cl'), 'wb') as cl_test_fh:
+        for doc in range(len(doc_spans) - 1):
             docs_count += 1
             if docs_count % 1000 == 0:
                 logging.info('Processed {} documents'.format(docs_count))
-            full_doc_lines = []
-            line = reord_fh.readline()
-            current_doc_id = int(line.split('\t')[0].split('_')[-1])
-            current_doc_span = doc_spans[current_doc_id]
-            current_doc_len = current_doc_span[1] - current_doc_span[0]
+            full_doc_lines = read_doc(reord_fh, doc_spans)
 
             # If the clean test set is not yet large enough,
             # the current document goes into the test set
             if n_test_lines < test_size:
                 n_test_docs += 1
-                test_fh.write(line)
-                full_doc_lines.append(line)
-                for i in range(current_doc_len - 1):
-                    line = reord_fh.readline()
-                    test_fh.write(line)
-                    full_doc_lines.append(line)
+                test_fh.writelines(full_doc_lines)
                 # Compare document content with all lines that come after
                 # the current document, so that the clean test set does not
                 # contain any lines that are also in dev or train
-                del all_lines[:current_doc_len]
+                consume_lines(overlap_index, full_doc_lines)
                 clean_doc_lines = remove_overlapping_lines(full_doc_lines,
-                                                           all_lines)
+                                                           overlap_index)
                 n_full_test_lines += len(full_doc_lines)
                 n_test_lines += len(clean_doc_lines)
                 cl_test_fh.writelines(clean_doc_lines)
@@ -140,18 +154,13 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
             # dev set is not, the current document goes into the dev set
             elif n_dev_lines < dev_size:
                 n_dev_docs += 1
-                dev_fh.write(line)
-                full_doc_lines.append(line)
-                for i in range(current_doc_len - 1):
-                    line = reord_fh.readline()
-                    dev_fh.write(line)
-                    full_doc_lines.append(line)
+                dev_fh.writelines(full_doc_lines)
                 # Compare document content with all lines that come after
                 # the current document, so that the clean dev set does not
                 # contain any lines that are also in train
-                del all_lines[:current_doc_len]
+                consume_lines(overlap_index, full_doc_lines)
                 clean_doc_lines = remove_overlapping_lines(full_doc_lines,
-                                                           all_lines)
+                                                           overlap_index)
                 n_full_dev_lines += len(full_doc_lines)
                 n_dev_lines += len(clean_doc_lines)
                 cl_dev_fh.writelines(clean_doc_lines)
@@ -159,13 +168,8 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
             # After clean test and dev are filled, fill train
             elif n_train_lines < train_size:
                 n_train_docs += 1
-                train_fh.write(line)
-                full_doc_lines.append(line)
-                n_train_lines += 1
-                for i in range(current_doc_len - 1):
-                    train_fh.write(reord_fh.readline())
-                    full_doc_lines.append(line)
-                    n_train_lines += 1
+                train_fh.writelines(full_doc_lines)
+                n_train_lines += len(full_doc_lines)
 
     # Log test, dev and train statistics
     logging.info('Test set: {0} clean lines, {1} full lines, {2} documents'.
@@ -175,37 +179,74 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
     logging.info('Train set: {0} lines, {1} documents'.
                  format(n_train_lines, n_train_docs))
 
-    return (input_file+'.test', input_file+'.test-cl',
-            input_file+'.dev', input_file+'.dev-cl',
-            input_file+'.train')
+    return tuple(output_name(input_file, suffix) for suffix in
+                 ('.test', '.test-cl', '.dev', '.dev-cl', '.train'))
+
+
+def line_key(line):
+    """
+    Hash of the line content
+    (the first column is the doc id and is not taken into account)
+    """
+    return hash(line.split(b'\t', 1)[1])
+
+
+def build_overlap_index(reord_file):
+    """
+    Count how many times each line content occurs in the file;
+    only hashes of the lines are kept, not the lines themselves
+    """
+    overlap_index = Counter()
+    with open(reord_file, 'rb') as reord_fh:
+        for line in reord_fh:
+            overlap_index[line_key(line)] += 1
+    return overlap_index
 
 
-def item_in_list(items, key):
+def consume_lines(overlap_index, lines):
     """
-    Modified from https://stackoverflow.com/a/56537451
-    Find if the element key is present in the list items using binary search;
-    items MUST be sorted
+    Remove lines that have already been written from the index,
+    so that it only counts the lines that come after them
     """
-    idx = bisect_left(items, key)
-    try:
-        if items[idx] != key:
-            return False
-    except IndexError:
-        return False
-    return True
+    for line in lines:
+        key = line_key(line)
+        overlap_index[key] -= 1
+        if overlap_index[key] == 0:
+            del overlap_index[key]
 
 
-def remove_overlapping_lines(test_lines, train_lines):
+def remove_overlapping_lines(test_lines, overlap_index):
     """
-    Return test without the lines that are also in train
+    Return test without the lines that are also in the index
     (the first column is the doc id and is not taken into account)
     """
-    train_lines = sorted([line.split('\t', 1)[1] for line in train_lines])
-    clean_test_lines = []
-    for line in test_lines:
-        if not item_in_list(train_lines, line.split('\t', 1)[1]):
-            clean_test_lines.append(line)
-    return clean_test_lines
+    return [line for line in test_lines
+            if line_key(line) not in overlap_index]
+
+
+def split_file(input_file, test_size=3000, dev_size=3000,
+               train_size=1000000):
+    """
+    Shuffle the documents of input_file and separate them into
+    test, dev and train, return the output filenames
+    (outputs are compressed the same way as input_file)
+    """
+    logging.info('Input file: {}'.format(input_file))
+    # A compressed file is read as a stream,
+    # the reordered file is the only uncompressed copy
+    num_lines, num_docs = count_lines_and_docs(input_file)
+    shuffled_indices = shuffle_indices(num_docs)
+    spans = find_doc_spans(input_file)
+    reordered_file = reorder(input_file, shuffled_indices, spans)
+    result_files = write_test_dev_train(reordered_file, input_file, spans,
+                                        test_size, dev_size, train_size)
+    logging.info('Output files: {}'.format(result_files))
+
+    # Clean up: remove the reordered file
+    if os.path.exists(reordered_file):
+        os.remove(reordered_file)
+
+    return result_files
 
 
 if __name__ == '__main__':
@@ -223,19 +264,6 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # Separate the file
-    logging.info('Input file: {}'.format(args.input))
-    num_lines, num_docs = count_lines_and_docs(args.input)
-    shuffled_indices = shuffle_indices(num_docs)
-    spans = find_doc_spans(args.input)
-    reordered_file = reorder(args.input, shuffled_indices, spans)
-    result_files = write_test_dev_train(reordered_file, args.input, spans,
-                                        args.test_size, args.dev_size,
-                                        args.train_size)
-    test_full, test_clean, dev_full, dev_clean, train = result_files
-    logging.info('Output files: {}'.format(result_files))
-
-    # Clean up: remove the reordered file
-    if os.path.exists(reordered_file):
-        os.remove(reordered_file)
+    split_file(args.input, args.test_size, args.dev_size, args.train_size)
 
     logging.info('Done')
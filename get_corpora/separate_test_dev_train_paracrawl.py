@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import mmap
 import numpy as np
 import logging
-from bisect import bisect_left
+from io import BytesIO
+from collections import Counter
 from argparse import ArgumentParser
+from corpus_io import open_file, output_name, compression, decompress
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
@@ -16,7 +19,7 @@ def add_doc_numbers(input_file):
     Add number of document as the first column of the file
     """
     temp_filename = input_file + '.temp'
-    with open(input_file, 'r', encoding='utf8') as in_fh, \
+    with open_file(input_file, 'r', encoding='utf8') as in_fh, \
             open(temp_filename, 'w', encoding='utf8') as temp_fh:
         doc_name = ""
         n_docs = 0
@@ -32,6 +35,30 @@ def add_doc_numbers(input_file):
     return n_lines, n_docs, temp_filename
 
 
+def index_docs(input_file):
+    """
+    Number the documents and find the start position (in bytes) of each doc
+    in the original file in the same scan, without writing a temp file;
+    doc i spans bytes doc_offsets[i]:doc_offsets[i + 1]
+    """
+    doc_offsets = []
+    with open(input_file, 'rb') as fh:
+        doc_name = None
+        position = 0
+        line_count = 0
+        for line in fh:
+            line_count += 1
+            current_doc_name = line.split(b'\t', 1)[0]
+            if current_doc_name != doc_name:
+                doc_name = current_doc_name
+                doc_offsets.append(position)
+            position += len(line)
+        # Save end of the last doc
+        doc_offsets.append(position)
+    n_docs = len(doc_offsets) - 1
+    return line_count, n_docs, np.array(doc_offsets, dtype=np.int64)
+
+
 def shuffle_indices(n_docs):
     """
     Shuffle document indices w/fixed seed
@@ -45,29 +72,25 @@ def shuffle_indices(n_docs):
 
 def find_doc_spans(input_file):
     """
-    Find the start and end position of each doc in the original file
+    Find the start position (in bytes) of each doc in the original file;
+    doc i spans bytes doc_offsets[i]:doc_offsets[i + 1]
     """
     # logging.info('Finding document spans')
-    doc_spans = {}
-    with open(input_file, 'r', encoding='utf8') as fh:
+    doc_offsets = []
+    with open(input_file, 'rb') as fh:
         doc_num = None
-        for i, line in enumerate(fh):
-            line_doc_num = int(line.split('\t')[0])
+        position = 0
+        for line in fh:
+            line_doc_num = int(line.split(b'\t', 1)[0])
             # If doc id in line is different than the current doc id,
             # then this line starts a new doc
             if line_doc_num != doc_num:
-                doc_spans[line_doc_num] = [None, None]
-                current_doc_start = i
-                if i > 0:
-                    # The previous line ends the previous doc
-                    prev_doc_end = i
-                    doc_spans[line_doc_num - 1][1] = prev_doc_end
-                # Save start of current doc
-                doc_spans[line_doc_num][0] = current_doc_start
+                doc_offsets.append(position)
                 doc_num = line_doc_num
+            position += len(line)
         # Save end of the last doc
-        doc_spans[line_doc_num][1] = i + 1
-    return doc_spans
+        doc_offsets.append(position)
+    return np.array(doc_offsets, dtype=np.int64)
 
 
 def reorder(input_file, shuf_indices, doc_spans):
@@ -75,31 +98,84 @@ def reorder(input_file, shuf_indices, doc_spans):
     Write documents in shuffled order into file input_file+'-reord'
     """
     # logging.info('Reordering documents')
-    with open(input_file, 'r', encoding='utf8') as fh:
-        inp_lines = [line for line in fh.readlines()]
-    with open(input_file + '-reord', 'w', encoding='utf8') as reord_fh:
-        written_docs = 0
+    with open(input_file, 'rb') as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as inp_mm, \
+            open(input_file + '-reord', 'wb') as reord_fh:
         for ind in shuf_indices:
-            written_docs += 1
-            reord_fh.writelines(inp_lines[doc_spans[ind][0]:
-                                          doc_spans[ind][1]])
+            reord_fh.write(inp_mm[doc_spans[ind]:doc_spans[ind + 1]])
     return input_file + '-reord'
 
 
+def read_docs(reord_file, doc_spans):
+    """
+    Read whole documents one by one from the reordered file
+    and remove the document numbers from their lines
+    """
+    with open(reord_file, 'rb') as reord_fh:
+        for doc in range(len(doc_spans) - 1):
+            line = reord_fh.readline()
+            current_doc_id = int(line.split(b'\t', 1)[0])
+            current_doc_size = (doc_spans[current_doc_id + 1] -
+                                doc_spans[current_doc_id])
+            rest = reord_fh.read(current_doc_size - len(line))
+            yield remove_doc_numbers([line] + BytesIO(rest).readlines())
+
+
+def read_shuffled_docs(input_file, shuf_indices, doc_spans):
+    """
+    Read whole documents in shuffled order directly from the original file
+    """
+    with open(input_file, 'rb') as fh, \
+            mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as inp_mm:
+        for ind in shuf_indices:
+            doc = inp_mm[doc_spans[ind]:doc_spans[ind + 1]]
+            yield BytesIO(doc).readlines()
+
+
 def write_test_dev_train(reord_file, input_file, doc_spans,
                          test_size=3000, dev_size=3000, train_size=1000000,
                          clean=True):
     """
-    From a file with shuffled docs, first write whole documents into test
-    until total number of test lines that are not also present in dev or train
-    exceeds test_size, then repeat the same for dev, the rest
-    of the lines are written into train until train_size is exceeded
+    Separate a file with shuffled docs (and doc numbers) into test,
+    dev and train, see separate_docs
     """
+    # Index all lines to check for overlapping later
+    overlap_index = build_overlap_index(reord_file) if clean else None
+    return separate_docs(read_docs(reord_file, doc_spans), input_file,
+                         test_size, dev_size, train_size, overlap_index)
+
 
-    # Read in all lines to check for overlapping later
+def write_test_dev_train_direct(input_file, shuf_indices, doc_spans,
+                                test_size=3000, dev_size=3000,
+                                train_size=1000000, clean=True,
+                                plain_file=None):
+    """
+    Separate the original file into test, dev and train taking the docs
+    in shuffled order, without writing the temp and reordered files,
+    see separate_docs; if input_file is compressed, the docs are read
+    from its decompressed copy plain_file
+    """
+    plain_file = plain_file or input_file
+    # Index all lines to check for overlapping later
+    overlap_index = None
     if clean:
-        with open(reord_file, 'r', encoding='utf8') as reord_fh:
-            all_lines = [line for line in reord_fh.readlines()]
+        overlap_index = build_overlap_index(plain_file, doc_numbers=False)
+    return separate_docs(read_shuffled_docs(plain_file, shuf_indices,
+                                            doc_spans),
+                         input_file, test_size, dev_size, train_size,
+                         overlap_index)
+
+
+def separate_docs(docs, input_file, test_size=3000, dev_size=3000,
+                  train_size=1000000, overlap_index=None):
+    """
+    From shuffled docs, first write whole documents into test
+    until total number of test lines that are not also present in dev or train
+    exceeds test_size, then repeat the same for dev, the rest
+    of the lines are written into train until train_size is exceeded;
+    without overlap_index, overlapping lines are not removed
+    """
+    clean = overlap_index is not None
 
     logging.info('Separating test, dev and train')
     # Keep count of clean test, dev and train lines
@@ -108,42 +184,30 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
     n_full_test_lines, n_full_dev_lines = 0, 0
     docs_count, n_test_docs, n_dev_docs, n_train_docs = 0, 0, 0, 0
 
-    # Open reordered docs file for reading and all output files for writing
-    with open(reord_file, 'r', encoding='utf8') as reord_fh, \
-            open(input_file + '.test', 'w', encoding='utf8') as test_fh, \
-            open(input_file + '.dev', 'w', encoding='utf8') as dev_fh, \
-            open(input_file + '.train', 'w', encoding='utf8') as train_fh, \
-            open(input_file + '.dev-cl', 'w', encoding='utf8') as cl_dev_fh, \
-            open(input_file + '.test-cl', 'w', encoding='utf8') as cl_test_fh:
-        for doc in range(len(doc_spans)):
+    # Open all output files for writing
+    with open_file(output_name(input_file, '.test'), 'wb') as test_fh, \
+            open_file(output_name(input_file, '.dev'), 'wb') as dev_fh, \
+            open_file(output_name(input_file, '.train'), 'wb') as train_fh, \
+            open_file(output_name(input_file, '.dev-cl'), 'wb') as cl_dev_fh, \
+            open_file(output_name(input_file, '.test-cl'), 'wb') as cl_test_fh:
+        for full_doc_lines in docs:
             docs_count += 1
             if docs_count % 10000 == 0:
                 logging.info('Processed {} documents'.format(docs_count))
-            full_doc_lines = []
-            line = reord_fh.readline()
-            current_doc_id = int(line.split('\t')[0].split('_')[-1])
-            current_doc_span = doc_spans[current_doc_id]
-            current_doc_len = current_doc_span[1] - current_doc_span[0]
 
             # If the clean test set is not yet large enough,
             # the current document goes into the test set
             if n_test_lines < test_size:
                 n_test_docs += 1
-                test_fh.write('\t'.join(line.split('\t')[1:]))
-                full_doc_lines.append(line)
-                for i in range(current_doc_len - 1):
-                    line = reord_fh.readline()
-                    test_fh.write('\t'.join(line.split('\t')[1:]))
-                    full_doc_lines.append(line)
+                test_fh.writelines(full_doc_lines)
                 # Compare document content with all lines that come after
                 # the current document, so that the clean test set does not
                 # contain any lines that are also in dev or train
                 if clean:
-                    del all_lines[:current_doc_len]
+                    consume_lines(overlap_index, full_doc_lines)
                     clean_doc_lines = remove_overlapping_lines(full_doc_lines,
-                                                               all_lines)
-                    cl_test_fh.writelines(['\t'.join(doc_line.split('\t')[1:])
-                                           for doc_line in clean_doc_lines])
+                                                               overlap_index)
+                    cl_test_fh.writelines(clean_doc_lines)
                     n_test_lines += len(clean_doc_lines)
                 else:
                     n_test_lines += len(full_doc_lines)
@@ -153,21 +217,15 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
             # dev set is not, the current document goes into the dev set
             elif n_dev_lines < dev_size:
                 n_dev_docs += 1
-                dev_fh.write('\t'.join(line.split('\t')[1:]))
-                full_doc_lines.append(line)
-                for i in range(current_doc_len - 1):
-                    line = reord_fh.readline()
-                    dev_fh.write('\t'.join(line.split('\t')[1:]))
-                    full_doc_lines.append(line)
+                dev_fh.writelines(full_doc_lines)
                 # Compare document content with all lines that come after
                 # the current document, so that the clean dev set does not
                 # contain any lines that are also in train
                 if clean:
-                    del all_lines[:current_doc_len]
+                    consume_lines(overlap_index, full_doc_lines)
                     clean_doc_lines = remove_overlapping_lines(full_doc_lines,
-                                                               all_lines)
-                    cl_dev_fh.writelines(['\t'.join(doc_line.split('\t')[1:])
-                                          for doc_line in clean_doc_lines])
+                                                               overlap_index)
+                    cl_dev_fh.writelines(clean_doc_lines)
                     n_dev_lines += len(clean_doc_lines)
                 else:
                     n_dev_lines += len(full_doc_lines)
@@ -176,15 +234,8 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
             # After clean test and dev are filled, fill train
             elif n_train_lines < train_size:
                 n_train_docs += 1
-                train_fh.write('\t'.join(line.split('\t')[1:]))
-                full_doc_lines.append(line)
-                n_train_lines += 1
-                for i in range(current_doc_len - 1):
-                    train_fh.write('\t'.join(
-                        reord_fh.readline().split('\t')[1:]
-                    ))
-                    full_doc_lines.append(line)
-                    n_train_lines += 1
+                train_fh.writelines(full_doc_lines)
+                n_train_lines += len(full_doc_lines)
 
     # Log test, dev and train statistics
     if clean:
@@ -201,37 +252,51 @@ def write_test_dev_train(reord_file, input_file, doc_spans,
             f'Dev set: {n_full_dev_lines} lines, {n_dev_docs} documents')
     logging.info(f'Train set: {n_train_lines} lines, {n_train_docs} documents')
 
-    return (input_file+'.test', input_file+'.test-cl',
-            input_file+'.dev', input_file+'.dev-cl',
-            input_file+'.train')
+    return tuple(output_name(input_file, suffix) for suffix in
+                 ('.test', '.test-cl', '.dev', '.dev-cl', '.train'))
 
 
-def item_in_list(items, key):
+def remove_doc_numbers(lines):
     """
-    Modified from https://stackoverflow.com/a/56537451
-    Find if the element key is present in the list items using binary search;
-    items MUST be sorted
+    Remove the document number added by add_doc_numbers
+    (the first column) from each line
     """
-    idx = bisect_left(items, key)
-    try:
-        if items[idx] != key:
-            return False
-    except IndexError:
-        return False
-    return True
+    return [line.split(b'\t', 1)[1] for line in lines]
 
 
-def remove_overlapping_lines(test_lines, train_lines):
+def build_overlap_index(input_file, doc_numbers=True):
     """
-    Return test without the lines that are also in train
-    (the first column is the doc id and is not taken into account)
+    Count how many times each line content occurs in the file
+    (if doc_numbers, the first column is the doc number and is not
+    taken into account); only hashes of the lines are kept,
+    not the lines themselves
     """
-    train_lines = sorted([line.split('\t', 1)[1] for line in train_lines])
-    clean_test_lines = []
-    for line in test_lines:
-        if not item_in_list(train_lines, line.split('\t', 1)[1]):
-            clean_test_lines.append(line)
-    return clean_test_lines
+    overlap_index = Counter()
+    with open(input_file, 'rb') as fh:
+        for line in fh:
+            if doc_numbers:
+                line = line.split(b'\t', 1)[1]
+            overlap_index[hash(line)] += 1
+    return overlap_index
+
+
+def consume_lines(overlap_index, lines):
+    """
+    Remove lines that have already been written from the index,
+    so that it only counts the lines that come after them
+    """
+    for line in lines:
+        key = hash(line)
+        overlap_index[key] -= 1
+        if overlap_index[key] == 0:
+            del overlap_index[key]
+
+
+def remove_overlapping_lines(test_lines, overlap_index):
+    """
+    Return test without the lines that are also in the index
+    """
+    return [line for line in test_lines if hash(line) not in overlap_index]
 
 
 if __name__ == '__main__':
@@ -248,6 +313,13 @@ if __name__ == '__main__':
                         help="""With this flag, lines in test and dev 
                         which also appear in train will be removed""",
                         action='store_true', default=False)
+    parser.add_argument("--single_pass",
+                        help="""With this flag, docs are numbered and indexed
+                        in one scan and test, dev and train are written
+                        directly from the input file, without temp files
+                        (a compressed input is decompressed into one
+                        temporary plain copy)""",
+                        action='store_true', default=False)
     # parser.add_argument("--output", help="Filename for cleaned data")
 
     args = parser.parse_args()
@@ -261,25 +333,49 @@ if __name__ == '__main__':
         logging.info("Will NOT remove overlapping lines (lines from "
                      "test and dev may also appear in train)")
 
-    num_lines, num_docs, temp_file = add_doc_numbers(args.input)
-    logging.info(f'Docs: {num_docs}, lines: {num_lines}')
-    shuffled_indices = shuffle_indices(num_docs)
-    spans = find_doc_spans(temp_file)
-    reordered_file = reorder(temp_file, shuffled_indices, spans)
-    result_files = write_test_dev_train(reordered_file, args.input, spans,
-                                        args.test_size, args.dev_size,
-                                        args.train_size, args.clean_lines)
+    if args.single_pass:
+        # Documents are read from a memory map of the file,
+        # so a compressed file is decompressed first (the copy takes
+        # as much disk space as the uncompressed data, the default
+        # mode reads compressed input as a stream instead)
+        plain_file = args.input
+        if compression(args.input):
+            plain_file = decompress(args.input)
+        num_lines, num_docs, spans = index_docs(plain_file)
+        logging.info(f'Docs: {num_docs}, lines: {num_lines}')
+        shuffled_indices = shuffle_indices(num_docs)
+        result_files = write_test_dev_train_direct(args.input,
+                                                   shuffled_indices, spans,
+                                                   args.test_size,
+                                                   args.dev_size,
+                                                   args.train_size,
+                                                   args.clean_lines,
+                                                   plain_file)
+
+        # Clean up: remove the decompressed file
+        if plain_file != args.input and os.path.exists(plain_file):
+            os.remove(plain_file)
+    else:
+        num_lines, num_docs, temp_file = add_doc_numbers(args.input)
+        logging.info(f'Docs: {num_docs}, lines: {num_lines}')
+        shuffled_indices = shuffle_indices(num_docs)
+        spans = find_doc_spans(temp_file)
+        reordered_file = reorder(temp_file, shuffled_indices, spans)
+        result_files = write_test_dev_train(reordered_file, args.input, spans,
+                                            args.test_size, args.dev_size,
+                                            args.train_size, args.clean_lines)
+
+        # Clean up: remove the reordered and temp file
+        if os.path.exists(reordered_file):
+            os.remove(reordered_file)
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
     test_full, test_clean, dev_full, dev_clean, train = result_files
     if args.clean_lines:
         logging.info('Output files: {}'.format(result_files))
     else:
         logging.info('Output files: {}'.format((test_full, dev_full, train)))
 
-    # Clean up: remove the reordered and temp file
-    if os.path.exists(reordered_file):
-        os.remove(reordered_file)
-    if os.path.exists(temp_file):
-        os.remove(temp_file)
     # Remove dev-cl and test-cl if no cleaning was applied
     if not args.clean_lines:
         if os.path.exists(test_clean):
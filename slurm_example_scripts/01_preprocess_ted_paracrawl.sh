@@ -9,6 +9,9 @@
 #The job requires 1 task per node
 #SBATCH --ntasks-per-node=1
 
+#The task uses 8 cores for segmentation
+#SBATCH --cpus-per-task=8
+
 #The maximum walltime of the job is 72 h
 #SBATCH -t 10:00:00
 
@@ -36,8 +39,8 @@ echo "SentencePiece"
 
 # script apply_sentencepiece.py is included in this repo as well
 
-python3 $scriptspath/apply_sentencepiece.py --corpora $datapath/cl-*$srclang-$tgtlang*$srclang --model $modelspath/fs-en-et --action split
-python3 $scriptspath/apply_sentencepiece.py --corpora $datapath/cl-*$srclang-$tgtlang*$tgtlang --model $modelspath/fs-en-et --action split
+python3 $scriptspath/apply_sentencepiece.py --corpora $datapath/cl-*$srclang-$tgtlang*$srclang --model $modelspath/fs-en-et --action split --workers 8
+python3 $scriptspath/apply_sentencepiece.py --corpora $datapath/cl-*$srclang-$tgtlang*$tgtlang --model $modelspath/fs-en-et --action split --workers 8
 
 # rename the files so that they only have sp- at the beginning and not the full model name
 for corpus in ParaCrawl TED
@@ -14,6 +14,8 @@
 
 #SBATCH --mem=20GB
 
+#SBATCH --cpus-per-task=6
+
 module load python-3.6.3
 module load cudnn/7.2.1/cuda-9.2
 
@@ -22,47 +24,28 @@ source activate fairseq-da
 srclang=en
 tgtlang=et
 datapath=single-domain/sys-clusters/unseen
+scriptspath=../scripts
 
-# First, concatenate files from all corpora
-# (not necessary in this case because we are using one corpus at a time)
+# Shuffle source and target of train, dev and test in parallel
+# and save them into $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft
+# with filenames like train.en, valid.et, etc.
 
 for corpus in ParaCrawl TED
 do
-for set in train dev test
-do
- srclang=en
- tgtlang=et
- echo $set
- echo "src"
- cat $datapath/sp-cl-$corpus.$srclang-$tgtlang.$set.$srclang > $datapath/sp-cl-$corpus.$srclang-$tgtlang.$set.src
- echo "tgt"
- cat $datapath/sp-cl-$corpus.$srclang-$tgtlang.$set.$tgtlang > $datapath/sp-cl-$corpus.$srclang-$tgtlang.$set.tgt
-done
-
-# Paste source and target data into one file to shuffle them in parallel
-# Shuffle, then cut source and target back into separate files
-
-for set in train dev test
-do
- paste $datapath/sp-cl-$corpus.$srclang-$tgtlang.$set.src $datapath/sp-cl-$corpus.$srclang-$tgtlang.$set.tgt | shuf > $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.$set.both
- cut -f1 $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.$set.both > $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.$set.src
- cut -f2 $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.$set.both > $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.$set.tgt
-done
-
-# Copy data into $datapath/fairseq-data-$srclang-$tgtlang-base with filenames like train.en, valid.et, etc.
 
-mkdir -p $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft
 mkdir -p $datapath/bin-data-$srclang-$tgtlang-$corpus-ft
 
-cp $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.train.src $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/train.en
-cp $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.train.tgt $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/train.et
-cp $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.dev.src $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/valid.en
-cp $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.dev.tgt $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/valid.et
-cp $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.test.src $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/test.en
-cp $datapath/shuf-sp-cl-$corpus.$srclang-$tgtlang.test.tgt $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/test.et
+python3 $scriptspath/stage_fairseq_data.py --prefix $datapath/sp-cl-$corpus.$srclang-$tgtlang --src $srclang --tgt $tgtlang --out_dir $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft --seed 1 --workers 6
 
 # Finally, binarize for fairseq
 
+# the following lines are an alternative to the SentencePiece text files
+# of 01_preprocess_ted_paracrawl.sh and to fairseq-preprocess:
+# the plain sets are shuffled and encoded straight into the binary dataset
+
+# python3 $scriptspath/stage_fairseq_data.py --prefix $datapath/cl-$corpus.$srclang-$tgtlang --src $srclang --tgt $tgtlang --out_dir $datapath/plain-data-$srclang-$tgtlang-$corpus-ft --seed 1 --workers 6
+# python3 $scriptspath/binarize_sentencepiece.py --src $srclang --tgt $tgtlang --trainpref $datapath/plain-data-$srclang-$tgtlang-$corpus-ft/train --validpref $datapath/plain-data-$srclang-$tgtlang-$corpus-ft/valid --testpref $datapath/plain-data-$srclang-$tgtlang-$corpus-ft/test --destdir $datapath/bin-data-$srclang-$tgtlang-$corpus-ft --srcdict single-domain/sys-clusters/segmented/bin-data-$srclang-$tgtlang-base/dict.en.txt --model single-domain/preproc-models/fs-en-et --workers 6
+
 fairseq-preprocess --source-lang $srclang --target-lang $tgtlang \
     --trainpref $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/train --validpref $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/valid --testpref $datapath/fairseq-data-$srclang-$tgtlang-$corpus-ft/test \
     --destdir $datapath/bin-data-$srclang-$tgtlang-$corpus-ft --joined-dictionary \
@@ -34,24 +34,23 @@ EXP_NAME=concat
 SAVE_DIR=da-sysclusters/experiments/${srclang}_${tgtlang}_${EXP_NAME}
  for corpus in Europarl OpenSubtitles JRC-Acquis EMEA
  do
-  # translate
-  cat $DATA_PATH/sp-cl-$corpus.$srclang-$tgtlang.docs.$set.$srclang \
-    | fairseq-interactive $DATA_PATH/bin-data-$srclang-$tgtlang-base \
-      --source-lang $srclang --target-lang $tgtlang \
-      --path $SAVE_DIR/checkpoint_best.pt \
-      --buffer-size 2000 --batch-size 32 --beam 5 \
-    > $RESULTS_PATH/transl_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.sys
-	
-  # grep translations from the output file
-  grep "^H" $RESULTS_PATH/transl_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.sys | cut -f3 > $RESULTS_PATH/hyp_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.txt
-  # grep "^T" $RESULTS_PATH/out_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.sys | cut -f2 > $RESULTS_PATH/tgt_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.txt
-  
-  # de-sentencepiece
-  python3 ../scripts/apply_sentencepiece.py --corpora $RESULTS_PATH/hyp_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.txt --model single-domain/preproc-models/fs-en-et --action restore
-  
-  # calculate bleu w/sacrebleu
-  echo $EXP_NAME
-  echo $corpus
-  cat $RESULTS_PATH/de-fs-en-et-hyp_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.txt | sacrebleu single-domain/sys-clusters/cl-$corpus.$srclang-$tgtlang.docs.$set.$tgtlang
+  # translate in batches of sentences of similar length
+  # and de-sentencepiece the translations in the same process;
+  # the cache is keyed by the checkpoint, so all experiments share it
+  python3 ../scripts/translate.py \
+    --input $DATA_PATH/sp-cl-$corpus.$srclang-$tgtlang.docs.$set.$srclang \
+    --data $DATA_PATH/bin-data-$srclang-$tgtlang-base \
+    --src $srclang --tgt $tgtlang \
+    --path $SAVE_DIR/checkpoint_best.pt \
+    --max_tokens 4096 --max_sentences 128 --beam 5 \
+    --sp_model single-domain/preproc-models/fs-en-et \
+    --cache da-sysclusters/experiments/translation-cache.sqlite \
+    --output $RESULTS_PATH/de-fs-en-et-hyp_${srclang}_${tgtlang}_${EXP_NAME}_${corpus}.txt
  done
 
+# calculate bleu of all corpora w/sacrebleu in one process
+python3 ../scripts/evaluate_bleu.py --experiments $EXP_NAME \
+  --corpora Europarl OpenSubtitles JRC-Acquis EMEA \
+  --hyp_pattern "$RESULTS_PATH/de-fs-en-et-hyp_${srclang}_${tgtlang}_{experiment}_{corpus}.txt" \
+  --ref_pattern "single-domain/sys-clusters/cl-{corpus}.$srclang-$tgtlang.docs.$set.$tgtlang" \
+  --workers 4 --output $RESULTS_PATH/bleu_${srclang}_${tgtlang}_${EXP_NAME}.tsv
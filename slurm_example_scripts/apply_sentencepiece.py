@@ -2,13 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import time
+import hashlib
+import sqlite3
 import logging
 import sentencepiece as spm
+from collections import OrderedDict, deque
+from itertools import islice
+from multiprocessing import Pool
 from argparse import ArgumentParser
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
+# SentencePiece model used by the current process, see load_model
+sp = None
+
 
 def train(arguments):
     logging.info("Starting training")
@@ -18,55 +28,316 @@ def train(arguments):
         vocab_size=arguments.size)
 
 
+def load_model(model):
+    """
+    Load the SentencePiece model with the given prefix
+    (once per process)
+    """
+    global sp
+    sp = spm.SentencePieceProcessor(model_file=model + ".model")
+
+
+def to_str(piece):
+    """
+    Convert a subword to str, there might be unexpected behavior
+    and sentencepiece may return bytes
+    """
+    if type(piece) == bytes:
+        return piece.decode('utf-8')
+    return piece
+
+
+def encode_chunk(sentences):
+    """
+    Split a list of sentences into subwords,
+    return the lines to write into the output file
+    """
+    return [' '.join(map(to_str, pieces)) + '\n'
+            for pieces in sp.encode(sentences, out_type=str)]
+
+
+def decode_chunk(sentences):
+    """
+    Glue a list of subword-split sentences back into plain text,
+    return the lines to write into the output file
+    """
+    glued_sentences = [''] * len(sentences)
+    # Empty sentences are left out of the batch,
+    # sentencepiece cannot tell the type of an empty list
+    non_empty = [i for i, sentence in enumerate(sentences) if sentence]
+    if non_empty:
+        decoded = sp.decode([sentences[i].split() for i in non_empty])
+        for i, glued_sentence in zip(non_empty, decoded):
+            glued_sentences[i] = glued_sentence
+    return [to_str(glued_sentence) + '\n'
+            for glued_sentence in glued_sentences]
+
+
+def read_chunks(fh, chunk_size):
+    """
+    Read stripped lines from fh in lists of chunk_size lines
+    """
+    while True:
+        chunk = [line.strip() for line in islice(fh, chunk_size)]
+        if not chunk:
+            break
+        yield chunk
+
+
+def file_hash(filename, block_size=1 << 24):
+    """
+    SHA-1 of a file's contents, read a block at a time
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SentenceCache:
+    """
+    Persistent cache of processed sentences (e.g. SentencePiece splits
+    or translations) in an SQLite database, keyed by the hash of the model
+    (model_hash, e.g. the file_hash of the model file) and of the stripped
+    sentence, so that several models can share one database; each stored
+    chunk is committed, so that other processes using the same file see
+    it and an interrupted run keeps it, and when the cache holds more
+    than max_size sentences, the least recently used ones are removed;
+    the database also keeps the hashes of the model files, see file_hash
+    """
+
+    def __init__(self, filename, model_hash='', max_size=10000000,
+                 timeout=60):
+        self.max_size = max_size
+        self.hits, self.misses = 0, 0
+        # Output for the same sentence differs between models
+        # (may be set after opening, see file_hash)
+        self.model_hash = model_hash
+        # Wait up to timeout seconds while another process writes
+        self.connection = sqlite3.connect(filename, timeout=timeout)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS segments "
+                                "(key BLOB PRIMARY KEY, line TEXT NOT NULL, "
+                                "last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS "
+                                "segments_last_used ON segments (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS file_hashes "
+                                "(path TEXT PRIMARY KEY, "
+                                "size INTEGER NOT NULL, "
+                                "mtime_ns INTEGER NOT NULL, "
+                                "sha1 TEXT NOT NULL)")
+        self.connection.commit()
+        # Upper bound of the number of sentences, counted again
+        # only when it goes above max_size, see commit
+        self.size = self.connection.execute(
+            "SELECT COUNT(*) FROM segments").fetchone()[0]
+
+    def file_hash(self, filename):
+        """
+        file_hash of the file, kept in the database with its path,
+        size and modification time, so that a large file (e.g. a model
+        checkpoint) is only read again when it has changed
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        saved = self.connection.execute(
+            "SELECT sha1 FROM file_hashes WHERE path = ? AND size = ? "
+            "AND mtime_ns = ?", (path, stat.st_size, stat.st_mtime_ns)
+        ).fetchone()
+        if saved:
+            return saved[0]
+        logging.info("Hashing {}".format(filename))
+        sha1 = file_hash(path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, sha1))
+        self.connection.commit()
+        return sha1
+
+    def key(self, sentence):
+        return hashlib.blake2b(
+            (self.model_hash + sentence.strip()).encode('utf8'),
+            digest_size=16).digest()
+
+    def lookup(self, sentences):
+        """
+        Return the cached output line of each sentence (None if missing)
+        """
+        keys = [self.key(sentence) for sentence in sentences]
+        found = {}
+        # Stay below the SQLite limit on the number of query parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            found.update(self.connection.execute(
+                "SELECT key, line FROM segments WHERE key IN ({})".format(
+                    ','.join('?' * len(batch))), batch))
+        self.connection.executemany(
+            "UPDATE segments SET last_used = ? WHERE key = ?",
+            [(time.time(), key) for key in found])
+        lines = [found.get(key) for key in keys]
+        n_hits = sum(line is not None for line in lines)
+        self.hits += n_hits
+        self.misses += len(lines) - n_hits
+        return lines
+
+    def store(self, sentences, lines):
+        """
+        Add the output lines of the sentences and commit
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO segments VALUES (?, ?, ?)",
+            [(self.key(sentence), line, time.time())
+             for sentence, line in zip(sentences, lines)])
+        self.size += len(lines)
+        self.commit()
+
+    def commit(self):
+        """
+        Remove the least recently used sentences above max_size
+        and save the changes
+        """
+        if self.size > self.max_size:
+            self.size = self.connection.execute(
+                "SELECT COUNT(*) FROM segments").fetchone()[0]
+        if self.size > self.max_size:
+            self.connection.execute(
+                "DELETE FROM segments WHERE key IN (SELECT key FROM segments "
+                "ORDER BY last_used LIMIT ?)", (self.size - self.max_size,))
+            self.size = self.max_size
+        self.connection.commit()
+
+    def close(self):
+        """
+        Save and close the database
+        """
+        self.commit()
+        self.connection.close()
+        total = self.hits + self.misses
+        logging.info("Cache: {0} hits, {1} misses ({2:.1f}% hit rate)".format(
+            self.hits, self.misses, 100 * self.hits / total if total else 0))
+
+
+def submit_chunk(function, chunk, pool=None, cache=None):
+    """
+    Start applying function to the distinct sentences of the chunk
+    that are not in the cache
+    """
+    cached = cache.lookup(chunk) if cache else [None] * len(chunk)
+    missing = list(OrderedDict.fromkeys(
+        sentence for sentence, line in zip(chunk, cached) if line is None))
+    if not missing:
+        result = []
+    elif pool is None:
+        result = function(missing)
+    else:
+        result = pool.apply_async(function, (missing,))
+    return chunk, cached, missing, result
+
+
+def collect_chunk(submitted, cache=None):
+    """
+    Wait for the result of submit_chunk and return the output lines
+    of the whole chunk
+    """
+    chunk, cached, missing, result = submitted
+    if not isinstance(result, list):
+        result = result.get()
+    if cache:
+        cache.store(missing, result)
+    new_lines = dict(zip(missing, result))
+    return [new_lines[sentence] if line is None else line
+            for sentence, line in zip(chunk, cached)]
+
+
+def process_file(function, in_fh, out_fh, chunk_size, pool=None, workers=1,
+                 cache=None):
+    """
+    Apply function to chunks of lines read from in_fh (in a pool
+    of processes if pool is given, only to lines not in the cache
+    if cache is given) and write the results into out_fh
+    in the original order
+    """
+    # Keep a limited number of chunks in flight,
+    # so that memory use does not depend on the file size
+    pending = deque()
+    for chunk in read_chunks(in_fh, chunk_size):
+        pending.append(submit_chunk(function, chunk, pool, cache))
+        if len(pending) >= 2 * workers:
+            out_fh.writelines(collect_chunk(pending.popleft(), cache))
+    while pending:
+        out_fh.writelines(collect_chunk(pending.popleft(), cache))
+
+
+def make_pool(arguments):
+    """
+    Start a pool of processes with the model loaded in each of them,
+    or load the model in this process if only one worker is used
+    """
+    if arguments.workers > 1:
+        return Pool(arguments.workers, initializer=load_model,
+                    initargs=(arguments.model,))
+    load_model(arguments.model)
+    return None
+
+
 def split(arguments):
     # Load model
-    sp = spm.SentencePieceProcessor(model_file=arguments.model + ".model")
+    pool = make_pool(arguments)
+    cache = None
+    if arguments.cache:
+        cache = SentenceCache(arguments.cache, max_size=arguments.cache_size)
+        cache.model_hash = cache.file_hash(arguments.model + '.model')
 
     # Split each input file
-    for corpus in arguments.corpora:
-        logging.info("Splitting file {}".format(corpus))
-        with open(corpus, 'r', encoding='utf8') as f:
-            sentences = [line.strip() for line in f.readlines()]
-        # Create output file name (add the model prefix)
-        out_file = os.path.join(os.path.split(corpus)[0],
-                                os.path.split(arguments.model)[1] + '-' +
-                                os.path.split(corpus)[1])
-        with open(out_file, 'w', encoding='utf8') as f:
-            # Process sentences
-            for sentence in sentences:
-                pieces = sp.encode(sentence, out_type=str)
-                # Check result type, there might be unexpected behavior
-                if type(pieces[0]) == str:
-                    f.write(' '.join([word for word
-                                      in sp.encode(sentence, out_type=str)]))
-                elif type(pieces[0]) == bytes:
-                    f.write(' '.join([word.decode('utf-8') for word
-                                      in sp.encode(sentence, out_type=str)]))
-                f.write('\n')
+    try:
+        for corpus in arguments.corpora:
+            logging.info("Splitting file {}".format(corpus))
+            # Create output file name (add the model prefix)
+            out_file = os.path.join(os.path.split(corpus)[0],
+                                    os.path.split(arguments.model)[1] + '-' +
+                                    os.path.split(corpus)[1])
+            with open(corpus, 'r', encoding='utf8') as in_f, \
+                    open(out_file, 'w', encoding='utf8') as out_f:
+                process_file(encode_chunk, in_f, out_f, arguments.chunk_size,
+                             pool, arguments.workers, cache)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache:
+            cache.close()
 
 
 def restore(arguments):
     # Load model
-    sp = spm.SentencePieceProcessor(model_file=arguments.model + ".model")
-
-    for corpus in arguments.corpora:
-        logging.info("De-sp file {}".format(corpus))
-        with open(corpus, 'r', encoding='utf-8') as f:
-            sentences = [line.strip() for line in f.readlines()]
-        # Create output file name (add the model prefix)
-        out_file = os.path.join(os.path.split(corpus)[0],
-                                'de-' + os.path.split(arguments.model)[1] +
-                                '-' + os.path.split(corpus)[1])
-        with open(out_file, 'w', encoding='utf8') as f:
-            # Process sentences
-            for sentence in sentences:
-                glued_sentence = sp.decode(sentence.split())
-                # Check result type, there might be unexpected behavior
-                if type(glued_sentence) == str:
-                    f.write(glued_sentence)
-                elif type(glued_sentence) == bytes:
-                    f.write(glued_sentence.decode('utf-8'))
-                f.write('\n')
+    pool = make_pool(arguments)
+
+    try:
+        for corpus in arguments.corpora:
+            # With '-' instead of a file name, read from standard input
+            # and write into standard output
+            if corpus == '-':
+                logging.info("De-sp standard input")
+                with open(sys.stdin.fileno(), 'r', encoding='utf-8',
+                          closefd=False) as in_f, \
+                        open(sys.stdout.fileno(), 'w', encoding='utf8',
+                             closefd=False) as out_f:
+                    process_file(decode_chunk, in_f, out_f,
+                                 arguments.chunk_size, pool, arguments.workers)
+                continue
+            logging.info("De-sp file {}".format(corpus))
+            # Create output file name (add the model prefix)
+            out_file = os.path.join(os.path.split(corpus)[0],
+                                    'de-' + os.path.split(arguments.model)[1] +
+                                    '-' + os.path.split(corpus)[1])
+            with open(corpus, 'r', encoding='utf-8') as in_f, \
+                    open(out_file, 'w', encoding='utf8') as out_f:
+                process_file(decode_chunk, in_f, out_f,
+                             arguments.chunk_size, pool, arguments.workers)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 if __name__ == '__main__':
@@ -82,11 +353,23 @@ if __name__ == '__main__':
                         default=32000, help="Vocabulary size "
                                             "(for training mode)")
     parser.add_argument("--corpora", dest="corpora", nargs="+",
-                        help="File names of all files separated by spaces",
+                        help="File names of all files separated by spaces "
+                             "('-' for standard input and output "
+                             "in 'restore' mode)",
                         required=True)
     parser.add_argument("--model", dest="model",
                         help="SentencePiece model file prefix or prefix "
                              "of an existing model", default="wordpieces")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used for splitting "
+                             "or restoring")
+    parser.add_argument("--chunk_size", type=int, default=10000,
+                        help="Number of sentences processed at a time")
+    parser.add_argument("--cache", default=None,
+                        help="SQLite file for caching split sentences "
+                             "between runs (for splitting mode)")
+    parser.add_argument("--cache_size", type=int, default=10000000,
+                        help="Maximum number of sentences kept in the cache")
 
     args = parser.parse_args()
 
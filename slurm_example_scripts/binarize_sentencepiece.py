@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import struct
+import logging
+import numpy as np
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+import apply_sentencepiece
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+# Special symbols that fairseq puts before the dictionary entries
+SPECIAL_SYMBOLS = ('<s>', '<pad>', '</s>', '<unk>')
+EOS_INDEX = SPECIAL_SYMBOLS.index('</s>')
+UNK_INDEX = SPECIAL_SYMBOLS.index('<unk>')
+# Header of the fairseq mmap index file and its data type codes
+INDEX_MAGIC = b'MMIDIDX\x00\x00'
+DTYPE_CODES = {np.uint16: 8, np.int32: 4}
+
+# Dictionary used by the current process, see load_model_and_dictionary
+vocab = None
+
+
+def read_dictionary(dict_file):
+    """
+    Read a fairseq dictionary file (lines "symbol count"),
+    return a dict of symbol -> index and the number of symbols
+    """
+    indices = {symbol: index for index, symbol in enumerate(SPECIAL_SYMBOLS)}
+    n_symbols = len(SPECIAL_SYMBOLS)
+    with open(dict_file, 'r', encoding='utf8') as dict_fh:
+        for line in dict_fh:
+            symbol, field = line.rstrip().rsplit(' ', 1)
+            # the same flag as in fairseq: a repeated symbol
+            # gets a new index
+            overwrite = field == '#fairseq:overwrite'
+            if overwrite:
+                symbol, field = symbol.rsplit(' ', 1)
+            if symbol in indices and not overwrite:
+                raise RuntimeError(f"Duplicate symbol '{symbol}' "
+                                   f"in {dict_file}")
+            indices[symbol] = n_symbols
+            n_symbols += 1
+    return indices, n_symbols
+
+
+def index_dtype(n_symbols):
+    """
+    Data type fairseq-preprocess uses for the token ids
+    """
+    return np.uint16 if n_symbols < 65500 else np.int32
+
+
+def load_model_and_dictionary(model, dict_file):
+    """
+    Load the SentencePiece model and the dictionary (once per process)
+    """
+    global vocab
+    apply_sentencepiece.load_model(model)
+    vocab = read_dictionary(dict_file)
+
+
+def encode_ids_chunk(sentences):
+    """
+    Split a list of sentences into subwords and convert them into
+    dictionary indices the same way fairseq-preprocess does
+    (unknown subwords become <unk>, </s> is added to each sentence),
+    return an array of indices for each sentence
+    """
+    indices, n_symbols = vocab
+    dtype = index_dtype(n_symbols)
+    # split() gives the same tokens as fairseq's tokenize_line
+    return [np.array([indices.get(piece, UNK_INDEX) for piece in line.split()]
+                     + [EOS_INDEX], dtype=dtype)
+            for line in apply_sentencepiece.encode_chunk(sentences)]
+
+
+class IndexedDatasetWriter:
+    """
+    Writer of the fairseq mmap indexed dataset format: the token ids
+    of all sentences in PREFIX.bin and their sizes and positions
+    in PREFIX.idx; it has the writelines method of a file,
+    so that apply_sentencepiece.process_file can write into it
+    """
+
+    def __init__(self, prefix, dtype):
+        self.prefix = prefix
+        self.dtype = dtype
+        self.bin_fh = open(prefix + '.bin', 'wb')
+        self.sizes = []
+        self.n_tokens, self.n_unks = 0, 0
+
+    def writelines(self, sentences_ids):
+        sizes = np.array([len(ids) for ids in sentences_ids], dtype=np.int32)
+        if len(sentences_ids):
+            ids = np.concatenate(sentences_ids).astype(self.dtype,
+                                                        copy=False)
+            self.bin_fh.write(ids.tobytes(order='C'))
+            self.n_unks += int(np.count_nonzero(ids == UNK_INDEX))
+        self.sizes.append(sizes)
+        self.n_tokens += int(sizes.sum())
+
+    def close(self):
+        """
+        Close the data file and write the index
+        """
+        self.bin_fh.close()
+        sizes = np.concatenate(self.sizes or [np.zeros(0, dtype=np.int32)])
+        pointers = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1] * np.dtype(self.dtype).itemsize,
+                  out=pointers[1:])
+        with open(self.prefix + '.idx', 'wb') as idx_fh:
+            idx_fh.write(INDEX_MAGIC)
+            idx_fh.write(struct.pack('<Q', 1))
+            idx_fh.write(struct.pack('<B', DTYPE_CODES[self.dtype]))
+            idx_fh.write(struct.pack('<Q', len(sizes)))
+            idx_fh.write(sizes.tobytes(order='C'))
+            idx_fh.write(pointers.tobytes(order='C'))
+        logging.info("{0}: {1} sents, {2} tokens, {3:.3f}% replaced by "
+                     "<unk>".format(self.prefix, len(sizes), self.n_tokens,
+                                    100 * self.n_unks / self.n_tokens
+                                    if self.n_tokens else 0))
+
+
+def binarize(arguments):
+    """
+    Encode the plain text sets PREF.LANG (PREF is trainpref, validpref
+    and testpref) into DESTDIR/{train,valid,test}.SRC-TGT.LANG.{bin,idx},
+    as fairseq-preprocess --joined-dictionary --srcdict DICT would
+    do with their SentencePiece-split versions
+    """
+    os.makedirs(arguments.destdir, exist_ok=True)
+    _, n_symbols = read_dictionary(arguments.srcdict)
+    dtype = index_dtype(n_symbols)
+
+    # Load model and dictionary
+    pool = None
+    if arguments.workers > 1:
+        pool = Pool(arguments.workers, initializer=load_model_and_dictionary,
+                    initargs=(arguments.model, arguments.srcdict))
+    else:
+        load_model_and_dictionary(arguments.model, arguments.srcdict)
+
+    try:
+        for split, prefix in (('train', arguments.trainpref),
+                              ('valid', arguments.validpref),
+                              ('test', arguments.testpref)):
+            if prefix is None:
+                continue
+            for lang in (arguments.src, arguments.tgt):
+                logging.info("Binarizing file {}".format(f'{prefix}.{lang}'))
+                writer = IndexedDatasetWriter(
+                    f'{arguments.destdir}/{split}.{arguments.src}-'
+                    f'{arguments.tgt}.{lang}', dtype)
+                with open(f'{prefix}.{lang}', 'r', encoding='utf8') as in_f:
+                    apply_sentencepiece.process_file(
+                        encode_ids_chunk, in_f, writer, arguments.chunk_size,
+                        pool, arguments.workers)
+                writer.close()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Save the dictionaries like fairseq-preprocess
+    for lang in (arguments.src, arguments.tgt):
+        shutil.copyfile(arguments.srcdict,
+                        f'{arguments.destdir}/dict.{lang}.txt')
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = ArgumentParser(description="""Split plain text with
+    SentencePiece and save it as a binarized fairseq dataset""")
+    parser.add_argument("--src", default='en', help="Source language")
+    parser.add_argument("--tgt", default='et', help="Target language")
+    parser.add_argument("--trainpref", default=None,
+                        help="Train file prefix (PREF.LANG)")
+    parser.add_argument("--validpref", default=None,
+                        help="Valid file prefix (PREF.LANG)")
+    parser.add_argument("--testpref", default=None,
+                        help="Test file prefix (PREF.LANG)")
+    parser.add_argument("--destdir", required=True,
+                        help="Directory for the binarized dataset")
+    parser.add_argument("--srcdict", required=True,
+                        help="Joined fairseq dictionary (e.g. dict.en.txt)")
+    parser.add_argument("--model", required=True,
+                        help="SentencePiece model file prefix")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used for encoding")
+    parser.add_argument("--chunk_size", type=int, default=10000,
+                        help="Number of sentences encoded at a time")
+
+    args = parser.parse_args()
+
+    binarize(args)
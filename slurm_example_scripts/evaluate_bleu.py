@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import sys
+import time
+import logging
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+from sacrebleu.metrics import BLEU
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+# Columns of the results table
+COLUMNS = ('experiment', 'corpus', 'bleu', 'precision_1', 'precision_2',
+           'precision_3', 'precision_4', 'bp', 'ratio', 'hyp_len', 'ref_len')
+
+# Reference file -> (BLEU scorer with the reference statistics cached,
+# number of reference lines) used by the current process,
+# see load_references and set_scorers
+scorers = {}
+
+
+def read_lines(filename):
+    """
+    Read the lines of a file without the line ends
+    (the way the sacrebleu command reads its inputs)
+    """
+    with open(filename, 'r', encoding='utf8') as fh:
+        return [line.rstrip('\n') for line in fh]
+
+
+def load_references(ref_files, trg_lang=''):
+    """
+    Read each reference file once and compute its n-gram statistics
+    (sacrebleu's default BLEU, as the sacrebleu command computes it),
+    return a dict of reference file -> (scorer, number of lines)
+    """
+    loaded = {}
+    for ref_file in ref_files:
+        if ref_file in loaded:
+            continue
+        references = read_lines(ref_file)
+        loaded[ref_file] = (BLEU(trg_lang=trg_lang, references=[references]),
+                            len(references))
+        logging.info(f'Loaded {len(references)} references from {ref_file}')
+    return loaded
+
+
+def set_scorers(loaded):
+    """
+    Use the scorers made by load_references in the current process
+    """
+    global scorers
+    scorers = loaded
+
+
+def score_file(job):
+    """
+    Score a hypothesis file against a loaded reference file,
+    return a row of the results table (None if the file is missing
+    or its number of lines differs from the reference)
+    """
+    experiment, corpus, hyp_file, ref_file = job
+    scorer, n_references = scorers[ref_file]
+    try:
+        hypotheses = read_lines(hyp_file)
+    except FileNotFoundError:
+        logging.warning(f'Missing hypothesis file {hyp_file}')
+        return None
+    if len(hypotheses) != n_references:
+        logging.warning(f'{hyp_file} has {len(hypotheses)} lines, '
+                        f'{ref_file} has {n_references}')
+        return None
+    score = scorer.corpus_score(hypotheses, None)
+    return ([experiment, corpus, round(score.score, 2)] +
+            [round(precision, 1) for precision in score.precisions] +
+            [round(score.bp, 3), round(score.sys_len / score.ref_len, 3)
+             if score.ref_len else 0, score.sys_len, score.ref_len])
+
+
+def evaluate(experiments, corpora, hyp_pattern, ref_pattern, workers=1,
+             trg_lang=''):
+    """
+    Score the hypotheses of every experiment on every corpus:
+    the files are named by hyp_pattern (with {experiment} and {corpus}
+    placeholders) and ref_pattern (with a {corpus} placeholder);
+    the references are loaded once and passed to the pool of workers
+    with their n-gram statistics instead of being loaded again
+    """
+    ref_files = {corpus: ref_pattern.format(corpus=corpus)
+                 for corpus in corpora}
+    loaded = load_references(ref_files.values(), trg_lang)
+    set_scorers(loaded)
+    jobs = [(experiment, corpus,
+             hyp_pattern.format(experiment=experiment, corpus=corpus),
+             ref_files[corpus])
+            for experiment in experiments for corpus in corpora]
+
+    start_time = time.perf_counter()
+    if workers > 1:
+        with Pool(workers, initializer=set_scorers,
+                  initargs=(loaded,)) as pool:
+            rows = pool.map(score_file, jobs, chunksize=1)
+    else:
+        rows = [score_file(job) for job in jobs]
+    rows = [row for row in rows if row is not None]
+    logging.info('Scored {0} of {1} hypothesis files in {2:.2f} s'.format(
+        len(rows), len(jobs), time.perf_counter() - start_time))
+    return rows
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = ArgumentParser(description="""Compute corpus-level BLEU
+    of the translations of several experiments on several corpora
+    in one process and save the scores as one table""")
+    parser.add_argument("--experiments", nargs='+', required=True,
+                        help="Experiment names (e.g. concat)")
+    parser.add_argument("--corpora", nargs='+', required=True,
+                        help="Corpus names (e.g. Europarl OpenSubtitles)")
+    parser.add_argument("--hyp_pattern", type=str, required=True,
+                        help="Hypothesis file name with {experiment} "
+                             "and {corpus} placeholders")
+    parser.add_argument("--ref_pattern", type=str, required=True,
+                        help="Reference file name with a {corpus} "
+                             "placeholder")
+    parser.add_argument("--trg_lang", type=str, default='',
+                        help="Target language (selects the tokenizer "
+                             "for zh, ja and ko as sacrebleu -l does)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used for scoring")
+    parser.add_argument("--format", choices=['csv', 'tsv'], default='tsv',
+                        help="Format of the results table")
+    parser.add_argument("--output", type=str, default='-',
+                        help="Results table (standard output by default)")
+
+    args = parser.parse_args()
+
+    results = evaluate(args.experiments, args.corpora, args.hyp_pattern,
+                       args.ref_pattern, args.workers, args.trg_lang)
+    if args.output == '-':
+        output_fh = open(sys.stdout.fileno(), 'w', encoding='utf8',
+                         closefd=False)
+    else:
+        output_fh = open(args.output, 'w', encoding='utf8', newline='')
+    with output_fh:
+        writer = csv.writer(output_fh,
+                            delimiter=',' if args.format == 'csv' else '\t',
+                            lineterminator='\n')
+        writer.writerow(COLUMNS)
+        writer.writerows(results)
+    logging.info('Signature: {}'.format(
+        next(iter(scorers.values()))[0].get_signature()
+        if scorers else None))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from argparse import ArgumentParser
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+# Size of the blocks read when indexing a file
+BLOCK_SIZE = 1 << 24
+# Buffer size of the output files
+BUFFER_SIZE = 1 << 20
+# Input sets and the names fairseq-preprocess expects for them
+SPLITS = (('train', 'train'), ('dev', 'valid'), ('test', 'test'))
+
+
+def index_lines(filename):
+    """
+    Find the start position (in bytes) of each line of the file;
+    line i spans bytes offsets[i]:offsets[i + 1]
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    size = 0
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            newlines = np.flatnonzero(
+                np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            offsets.append(newlines.astype(np.int64) + size + 1)
+            size += len(block)
+    offsets = np.concatenate(offsets)
+    # the last line may not end with a newline
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+def count_lines(filename):
+    """
+    Count lines in a file
+    """
+    return len(index_lines(filename)) - 1
+
+
+def shuffle_file(input_file, output_file, permutation, batch_size=1000000):
+    """
+    Write the lines of input_file into output_file in the order
+    given by permutation (output line i is input line permutation[i]),
+    so that files shuffled with the same permutation stay aligned;
+    the lines are copied from a memory map of input_file a batch
+    of batch_size output lines at a time, reading each batch in file
+    order, so that memory use is bounded by the line index and the batch
+    """
+    n_lines = len(permutation)
+    offsets = index_lines(input_file)
+    assert len(offsets) - 1 == n_lines, \
+        f'{input_file} has {len(offsets) - 1} lines instead of {n_lines}'
+
+    with open(output_file, 'wb', buffering=BUFFER_SIZE) as out_fh:
+        if n_lines == 0:
+            return output_file
+        with open(input_file, 'rb') as in_fh, \
+                mmap.mmap(in_fh.fileno(), 0,
+                          access=mmap.ACCESS_READ) as in_mm:
+            for start in range(0, n_lines, batch_size):
+                batch = permutation[start:start + batch_size]
+                # read the lines of the batch in the order of the file
+                order = np.argsort(batch)
+                line_nums = batch[order]
+                batch_lines = [None] * len(batch)
+                for position, line_start, line_end in zip(
+                        order.tolist(), offsets[line_nums].tolist(),
+                        offsets[line_nums + 1].tolist()):
+                    line = in_mm[line_start:line_end]
+                    if not line.endswith(b'\n'):
+                        line += b'\n'
+                    batch_lines[position] = line
+                out_fh.writelines(batch_lines)
+    return output_file
+
+
+def stage(prefix, src_lang, tgt_lang, out_dir, seed=1, workers=1,
+          batch_size=1000000):
+    """
+    Shuffle the parallel sets PREFIX.{train,dev,test}.{src_lang,tgt_lang}
+    keeping source and target lines aligned (both files of a set
+    are shuffled with one permutation) and write them into out_dir
+    with the names fairseq-preprocess expects ({train,valid,test}.LANG);
+    all files are shuffled in parallel by workers processes
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    jobs = []
+    for split, fairseq_split in SPLITS:
+        n_lines = count_lines(f'{prefix}.{split}.{src_lang}')
+        logging.info(f'{split}: {n_lines} lines')
+        permutation = rng.permutation(n_lines)
+        for lang in (src_lang, tgt_lang):
+            jobs.append((f'{prefix}.{split}.{lang}',
+                         f'{out_dir}/{fairseq_split}.{lang}', permutation))
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(shuffle_file, input_file, output_file,
+                                   permutation, batch_size)
+                   for input_file, output_file, permutation in jobs]
+        output_files = [future.result() for future in futures]
+    logging.info(f'Shuffled files saved into {output_files}')
+    return output_files
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = ArgumentParser(description="""Shuffle parallel train, dev
+    and test sets and save them for fairseq-preprocess""")
+    parser.add_argument("--prefix", type=str, required=True,
+                        help="Prefix of the input files, "
+                             "PREFIX.{train,dev,test}.LANG")
+    parser.add_argument("--src", type=str, default='en',
+                        help="Source language")
+    parser.add_argument("--tgt", type=str, default='et',
+                        help="Target language")
+    parser.add_argument("--out_dir", type=str, required=True,
+                        help="Directory for the shuffled files")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for shuffling")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of files shuffled at the same time")
+    parser.add_argument("--batch_size", type=int, default=1000000,
+                        help="Number of lines copied at a time")
+
+    args = parser.parse_args()
+
+    logging.info(f'Shuffling with seed {args.seed}')
+    stage(args.prefix, args.src, args.tgt, args.out_dir, args.seed,
+          args.workers, args.batch_size)
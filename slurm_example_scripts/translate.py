@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import logging
+import numpy as np
+from argparse import ArgumentParser
+
+import apply_sentencepiece
+
+try:
+    import torch
+    from fairseq.models.transformer import TransformerModel
+except ImportError:
+    TransformerModel = None
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+
+
+def sentence_lengths(sentences):
+    """
+    Number of subwords in each SentencePiece-split sentence
+    (with the end of sentence symbol added by fairseq)
+    """
+    return np.array([len(sentence.split()) + 1 for sentence in sentences],
+                    dtype=np.int64)
+
+
+def make_batches(lengths, max_tokens=4096, max_sentences=128):
+    """
+    Group sentence indices into batches of sentences of similar length:
+    the sentences are sorted by length (longest first) and each batch
+    is filled while the padded batch (number of sentences times
+    the longest length) has at most max_tokens tokens and at most
+    max_sentences sentences; a longer sentence gets a batch of its own
+    """
+    order = np.argsort(-lengths, kind='stable')
+    batches, batch, batch_len = [], [], 0
+    for index, length in zip(order.tolist(), lengths[order].tolist()):
+        # the first sentence in the batch is the longest
+        if batch and ((len(batch) + 1) * batch_len > max_tokens or
+                      len(batch) >= max_sentences):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            batch_len = length
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def fixed_batches(n_sentences, batch_size=32):
+    """
+    Batches of batch_size sentences in the input order
+    (for comparing with make_batches)
+    """
+    return [list(range(start, min(start + batch_size, n_sentences)))
+            for start in range(0, n_sentences, batch_size)]
+
+
+def padding_ratio(lengths, batches):
+    """
+    Share of padding among the tokens of the padded batches
+    """
+    padded = sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+    return 1 - int(lengths.sum()) / padded if padded else 0
+
+
+def translate_sentences(sentences, generate, batches):
+    """
+    Translate the sentences with generate (a callable which takes
+    a list of sentences and returns their translations) a batch
+    at a time, return the translations in the original order
+    """
+    translations = [None] * len(sentences)
+    for batch_num, batch in enumerate(batches, 1):
+        for index, translation in zip(
+                batch, generate([sentences[index] for index in batch])):
+            translations[index] = translation
+        if batch_num % 100 == 0:
+            logging.info("Translated {} batches".format(batch_num))
+    return translations
+
+
+def translate_distinct(sentences, load_generator, max_tokens=4096,
+                       max_sentences=128, cache=None):
+    """
+    Translate each distinct sentence that is not in the cache once
+    (see apply_sentencepiece.submit_chunk), in batches made
+    by make_batches, and return the translations of all sentences
+    in the original order; load_generator is called to get
+    the generate callable only if something has to be translated
+    """
+    def translate_missing(missing):
+        logging.info("Translating {0} distinct sentences out of {1}".format(
+            len(missing), len(sentences)))
+        return translate_sentences(
+            missing, load_generator(),
+            make_batches(sentence_lengths(missing), max_tokens,
+                         max_sentences))
+
+    return apply_sentencepiece.collect_chunk(
+        apply_sentencepiece.submit_chunk(translate_missing, sentences,
+                                         cache=cache), cache)
+
+
+def translation_hash(cache, checkpoint, data_dir, src_lang, tgt_lang,
+                     beam=5, fp16=False):
+    """
+    Hash of everything that changes the translation of a sentence:
+    the checkpoint, the dictionaries and the decoding parameters
+    (the file hashes are kept in the cache, see SentenceCache.file_hash)
+    """
+    params = json.dumps({'src': src_lang, 'tgt': tgt_lang, 'beam': beam,
+                         'fp16': fp16}, sort_keys=True)
+    hashes = [cache.file_hash(filename) for filename in
+              [checkpoint] + [f'{data_dir}/dict.{lang}.txt'
+                              for lang in (src_lang, tgt_lang)]]
+    return '-'.join(hashes + [params])
+
+
+def fairseq_generator(checkpoint, data_dir, src_lang, tgt_lang, beam=5,
+                      fp16=False, max_tokens=4096, max_sentences=128):
+    """
+    Load a fairseq checkpoint, return a generate callable that
+    translates a batch of SentencePiece-split sentences with beam
+    search into SentencePiece-split translations (like the H lines
+    of fairseq-interactive)
+    """
+    if TransformerModel is None:
+        raise ImportError("Translating with a checkpoint requires fairseq")
+    # with the same batch limits as make_batches,
+    # fairseq does not split the batches again
+    model = TransformerModel.from_pretrained(
+        os.path.dirname(checkpoint) or '.',
+        checkpoint_file=os.path.basename(checkpoint),
+        data_name_or_path=data_dir, source_lang=src_lang,
+        target_lang=tgt_lang, beam=beam, max_tokens=max_tokens,
+        batch_size=max_sentences)
+    model.eval()
+    if torch.cuda.is_available():
+        model.cuda()
+    else:
+        logging.info("No GPU, translating on CPU")
+    if fp16:
+        model.half()
+
+    def generate(sentences):
+        hypotheses = model.generate([model.encode(sentence)
+                                     for sentence in sentences], beam=beam)
+        return [model.decode(hypos[0]['tokens']) for hypos in hypotheses]
+
+    return generate
+
+
+def stub_generator(hidden_size=256, seed=0):
+    """
+    Stand-in for a model for benchmarking batching on CPU:
+    does work proportional to the padded batch size
+    and returns the sentences unchanged
+    """
+    rng = np.random.default_rng(seed)
+    weights = rng.standard_normal((hidden_size, hidden_size)).astype(
+        np.float32)
+
+    def generate(sentences):
+        lengths = sentence_lengths(sentences)
+        states = np.ones((len(sentences), int(lengths.max()), hidden_size),
+                         dtype=np.float32)
+        for _ in range(4):
+            states = np.tanh(states @ weights)
+        return list(sentences)
+
+    return generate
+
+
+def benchmark(sentences, max_tokens, max_sentences, batch_size=32):
+    """
+    Compare sorted token-budget batches with fixed-size batches
+    in the input order on the stub model
+    """
+    lengths = sentence_lengths(sentences)
+    generate = stub_generator()
+    for name, batches in (
+            ('fixed', fixed_batches(len(sentences), batch_size)),
+            ('sorted', make_batches(lengths, max_tokens, max_sentences))):
+        start_time = time.perf_counter()
+        translations = translate_sentences(sentences, generate, batches)
+        elapsed = time.perf_counter() - start_time
+        assert translations == sentences, 'Order was not restored'
+        logging.info("{0}: {1} batches, {2:.1%} padding, {3:.2f} s "
+                     "({4:.0f} sentences/sec)".format(
+                         name, len(batches),
+                         padding_ratio(lengths, batches), elapsed,
+                         len(sentences) / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = ArgumentParser(description="""Translate a SentencePiece-split
+    file in batches of sentences of similar length""")
+    parser.add_argument("--input", required=True,
+                        help="SentencePiece-split source file "
+                             "('-' for standard input)")
+    parser.add_argument("--output", default='-',
+                        help="File for the translations, one per line "
+                             "in the input order (standard output "
+                             "by default)")
+    parser.add_argument("--path", help="Model checkpoint")
+    parser.add_argument("--data", help="Binarized data directory "
+                                       "with the dictionaries")
+    parser.add_argument("--src", default='en', help="Source language")
+    parser.add_argument("--tgt", default='et', help="Target language")
+    parser.add_argument("--beam", type=int, default=5, help="Beam size")
+    parser.add_argument("--fp16", action='store_true', default=False,
+                        help="Translate in half precision")
+    parser.add_argument("--max_tokens", type=int, default=4096,
+                        help="Maximum number of (padded) source tokens "
+                             "in a batch")
+    parser.add_argument("--max_sentences", type=int, default=128,
+                        help="Maximum number of sentences in a batch")
+    parser.add_argument("--sp_model", default=None,
+                        help="SentencePiece model file prefix, with it "
+                             "the translations are glued into plain text")
+    parser.add_argument("--cache", default=None,
+                        help="SQLite file for caching translations "
+                             "between runs, keyed by the checkpoint, "
+                             "dictionaries and decoding parameters, so "
+                             "several models can share it; it also keeps "
+                             "the hash of the checkpoint, which is only "
+                             "computed again when the checkpoint changes "
+                             "(not used by default)")
+    parser.add_argument("--cache_size", type=int, default=10000000,
+                        help="Maximum number of sentences kept in the cache")
+    parser.add_argument("--benchmark", action='store_true', default=False,
+                        help="Compare batching strategies "
+                             "on a stub model instead of translating")
+
+    args = parser.parse_args()
+
+    if args.input == '-':
+        in_f = open(sys.stdin.fileno(), 'r', encoding='utf8', closefd=False)
+    else:
+        in_f = open(args.input, 'r', encoding='utf8')
+    with in_f:
+        source = [line.strip() for line in in_f]
+
+    if args.benchmark:
+        benchmark(source, args.max_tokens, args.max_sentences)
+        sys.exit(0)
+
+    logging.info("Translating {0} sentences from {1}".format(len(source),
+                                                             args.input))
+    cache = None
+    if args.cache:
+        cache = apply_sentencepiece.SentenceCache(args.cache,
+                                                  max_size=args.cache_size)
+        cache.model_hash = translation_hash(cache, args.path, args.data,
+                                            args.src, args.tgt, args.beam,
+                                            args.fp16)
+    try:
+        hypotheses = translate_distinct(
+            source, lambda: fairseq_generator(
+                args.path, args.data, args.src, args.tgt, args.beam,
+                args.fp16, args.max_tokens, args.max_sentences),
+            args.max_tokens, args.max_sentences, cache)
+    finally:
+        if cache:
+            cache.close()
+
+    if args.sp_model:
+        apply_sentencepiece.load_model(args.sp_model)
+        out_lines = apply_sentencepiece.decode_chunk(hypotheses)
+    else:
+        out_lines = [hypothesis + '\n' for hypothesis in hypotheses]
+    if args.output == '-':
+        out_f = open(sys.stdout.fileno(), 'w', encoding='utf8',
+                     closefd=False)
+    else:
+        out_f = open(args.output, 'w', encoding='utf8')
+    with out_f:
+        out_f.writelines(out_lines)
+    logging.info("Done")